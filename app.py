@@ -1,4 +1,4 @@
-from flask import Flask, send_from_directory, jsonify, request
+from flask import Flask, send_from_directory, jsonify, request, Response
 import os
 import json
 import uuid
@@ -9,6 +9,15 @@ import sys
 from flask import g
 import threading
 import subprocess  # 新增：用于执行系统命令
+import sqlite3
+import hashlib
+
+from gallery_schema import GALLERY_DB_NAME, init_gallery
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 app = Flask(__name__)
 
@@ -21,14 +30,25 @@ IMG_DIR = os.path.join(BASE_DIR, 'img')
 LOGS_DIR = os.path.join(BASE_DIR, 'logs')  # 先定义LOGS_DIR
 FLASK_LOG = os.path.join(LOGS_DIR, 'flask.log')  # 然后使用它
 GITEE_LOG = os.path.join(LOGS_DIR, 'gitee.log')
+METRICS_JSON = os.path.join(LOGS_DIR, 'metrics.json')
+HOUSEKEEPING_REPORT = os.path.join(LOGS_DIR, 'housekeeping.json')
+HOUSEKEEPING_REQUEST = os.path.join(LOGS_DIR, 'housekeeping.request')
+STARTUP_REPORT = os.path.join(LOGS_DIR, 'startup.json')
+METRICS_PROM = os.path.join(LOGS_DIR, 'metrics.prom')
 # Gitee图片目录
 GITEE_IMG_DIR = os.path.join(BASE_DIR, 'img', 'giteeimg')
+# 缩略图缓存目录
+GITEE_THUMB_DIR = os.path.join(BASE_DIR, 'img', 'giteeimg_thumbs')
+THUMB_SIZE = (320, 320)
+# 图库索引（由插件在保存图片时写入）
+GALLERY_DB = os.path.join(IMG_DIR, GALLERY_DB_NAME)
 
 # ==================== 目录初始化 ====================
 os.makedirs(HTML_DIR, exist_ok=True)
 os.makedirs(IMG_DIR, exist_ok=True, mode=0o755)
 os.makedirs(LOGS_DIR, exist_ok=True)
 os.makedirs(GITEE_IMG_DIR, exist_ok=True, mode=0o755)
+os.makedirs(GITEE_THUMB_DIR, exist_ok=True, mode=0o755)
 
 # ==================== 日志记录函数 ====================
 def log_access(request, response=None, status_code=200):
@@ -115,52 +135,250 @@ def load_personas():
 
 def save_personas(personas_data):
     try:
-        with open(PERSONAS_FILE, 'w', encoding='utf-8') as f:
+        # 先写临时文件再替换，避免插件读到写了一半的文件
+        tmp_file = PERSONAS_FILE + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
             json.dump(personas_data, f, ensure_ascii=False, indent=2)
+        try:
+            os.replace(tmp_file, PERSONAS_FILE)
+        except OSError:
+            # Docker单文件挂载时无法替换，退回直接写入
+            with open(PERSONAS_FILE, 'w', encoding='utf-8') as f:
+                json.dump(personas_data, f, ensure_ascii=False, indent=2)
+            os.remove(tmp_file)
         return True
     except Exception as e:
         print(f"保存人格失败: {e}")
         return False
 
+# ==================== 日志读取工具 ====================
+def tail_lines(path, max_lines, block_size=8192):
+    """从文件末尾按块倒序读取最后max_lines个完整行，返回 (内容, 已读到的offset)"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        position = file_size
+        data = b''
+        while position > 0 and data.count(b'\n') <= max_lines:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+    # 末尾未写完的行留给增量读取
+    lines = data.split(b'\n')
+    partial = lines.pop()
+    content = b'\n'.join(lines[-max_lines:])
+    if content:
+        content += b'\n'
+    return content.decode('utf-8', errors='replace'), file_size - len(partial)
+
+def read_from_offset(path, offset, max_bytes=1024 * 1024):
+    """从offset处读取新增的完整行，返回 (内容, 新offset, 是否被截断/轮转)"""
+    file_size = os.path.getsize(path)
+    if offset > file_size:
+        # 文件被轮转或清空，从头读取
+        return '', 0, True
+    if offset == file_size:
+        return '', offset, False
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(max_bytes)
+    # 只返回到最后一个完整行，剩余部分下次读取
+    last_newline = data.rfind(b'\n')
+    if last_newline == -1:
+        if len(data) < max_bytes:
+            return '', offset, False
+        last_newline = len(data) - 1
+    data = data[:last_newline + 1]
+    return data.decode('utf-8', errors='replace'), offset + len(data), False
+
 # ==================== Gitee日志接口 ====================
 @app.route('/api/get_gitee_log', methods=['GET'])
 def get_gitee_log():
-    """获取gitee.log最新500行内容"""
+    """获取gitee.log内容：不带offset时返回最新500行，带offset时只返回之后新增的内容"""
     try:
         if not os.path.exists(GITEE_LOG):
-            return jsonify({"success": True, "content": "gitee.log 日志文件尚未生成"})
+            return jsonify({"success": True, "content": "gitee.log 日志文件尚未生成", "offset": 0, "reset": True})
         
-        with open(GITEE_LOG, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            # 读取最后500行
-            if len(lines) > 500:
-                lines = lines[-500:]
-            content = ''.join(lines)
+        offset = request.args.get('offset', type=int)
+        if offset is None:
+            content, new_offset = tail_lines(GITEE_LOG, 500)
+            return jsonify({"success": True, "content": content, "offset": new_offset, "reset": True})
         
-        return jsonify({"success": True, "content": content})
+        content, new_offset, rotated = read_from_offset(GITEE_LOG, offset)
+        if rotated:
+            content, new_offset = tail_lines(GITEE_LOG, 500)
+        return jsonify({"success": True, "content": content, "offset": new_offset, "reset": rotated})
     except Exception as e:
         return jsonify({"success": False, "content": f"读取gitee.log失败: {str(e)}"})
 
+@app.route('/api/gitee_log/stream', methods=['GET'])
+def stream_gitee_log():
+    """以Server-Sent Events推送gitee.log新增内容"""
+    offset = request.args.get('offset', type=int)
+    
+    def generate(offset):
+        # 每次事件的data为JSON：{"content": ..., "offset": ..., "reset": ...}
+        if offset is None:
+            content, offset = tail_lines(GITEE_LOG, 500) if os.path.exists(GITEE_LOG) else ('', 0)
+            yield f"data: {json.dumps({'content': content, 'offset': offset, 'reset': True}, ensure_ascii=False)}\n\n"
+        idle = 0
+        while True:
+            time.sleep(1)
+            if not os.path.exists(GITEE_LOG):
+                continue
+            content, new_offset, rotated = read_from_offset(GITEE_LOG, offset)
+            if rotated:
+                content, new_offset = tail_lines(GITEE_LOG, 500)
+            offset = new_offset
+            if content or rotated:
+                idle = 0
+                yield f"data: {json.dumps({'content': content, 'offset': offset, 'reset': rotated}, ensure_ascii=False)}\n\n"
+            else:
+                idle += 1
+                if idle >= 15:
+                    # 心跳，防止代理断开空闲连接
+                    idle = 0
+                    yield ": keepalive\n\n"
+    
+    return Response(generate(offset), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+# ==================== 性能指标接口 ====================
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """获取插件写出的性能指标，format=prometheus时返回Prometheus文本格式"""
+    if request.args.get('format') == 'prometheus':
+        if not os.path.exists(METRICS_PROM):
+            return Response("", mimetype='text/plain; version=0.0.4')
+        with open(METRICS_PROM, 'r', encoding='utf-8') as f:
+            return Response(f.read(), mimetype='text/plain; version=0.0.4')
+    
+    try:
+        if not os.path.exists(METRICS_JSON):
+            return jsonify({"success": True, "data": None, "message": "暂无指标数据"})
+        with open(METRICS_JSON, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return jsonify({"success": True, "data": data})
+    except Exception as e:
+        return jsonify({"success": False, "message": f"读取指标失败: {str(e)}"}), 500
+
+@app.route('/api/housekeeping', methods=['GET', 'POST'])
+def housekeeping():
+    """GET返回最近一次清理报告，POST请求插件尽快执行一次清理"""
+    if request.method == 'POST':
+        try:
+            with open(HOUSEKEEPING_REQUEST, 'w', encoding='utf-8') as f:
+                f.write(datetime.now().isoformat())
+            return jsonify({"success": True, "message": "已提交清理请求，插件将在30秒内执行"})
+        except Exception as e:
+            return jsonify({"success": False, "message": f"提交清理请求失败: {str(e)}"}), 500
+    
+    try:
+        if not os.path.exists(HOUSEKEEPING_REPORT):
+            return jsonify({"success": True, "data": None, "pending": os.path.exists(HOUSEKEEPING_REQUEST), "message": "暂无清理记录"})
+        with open(HOUSEKEEPING_REPORT, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return jsonify({"success": True, "data": data, "pending": os.path.exists(HOUSEKEEPING_REQUEST)})
+    except Exception as e:
+        return jsonify({"success": False, "message": f"读取清理报告失败: {str(e)}"}), 500
+
+@app.route('/api/startup', methods=['GET'])
+def startup_report():
+    """返回插件最近一次启动预热的健康报告"""
+    try:
+        if not os.path.exists(STARTUP_REPORT):
+            return jsonify({"success": True, "data": None, "message": "暂无启动报告"})
+        with open(STARTUP_REPORT, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return jsonify({"success": True, "data": data})
+    except Exception as e:
+        return jsonify({"success": False, "message": f"读取启动报告失败: {str(e)}"}), 500
+
+# ==================== 图库索引 ====================
+def gallery_connect():
+    """打开图库索引，首次使用时建表并导入目录中已有的图片"""
+    conn = sqlite3.connect(GALLERY_DB, timeout=10)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    init_gallery(conn, GITEE_IMG_DIR)
+    return conn
+
+def format_image_row(row):
+    return {
+        'filename': row['filename'],
+        'size': f"{row['size'] / 1024:.2f} KB",
+        'create_time': datetime.fromtimestamp(row['created_at']).strftime('%Y-%m-%d %H:%M:%S'),
+        'persona_id': row['persona_id'],
+        'mode': row['mode'],
+        'url': f"/api/giteeimg/show/{row['filename']}",
+        'thumb_url': f"/api/giteeimg/thumb/{row['filename']}"
+    }
+
 # ==================== Gitee图片管理接口 ====================
 @app.route('/api/giteeimg/list', methods=['GET'])
 def get_giteeimg_list():
-    """获取giteeimg目录下所有图片"""
+    """分页获取图片列表
+    
+    参数：limit 每页数量；cursor 上一页返回的next_cursor；
+    date 日期(YYYY-MM-DD)；persona 人格ID；mode txt2img/img2img
+    """
     try:
-        img_list = []
-        img_extensions = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
-        for filename in os.listdir(GITEE_IMG_DIR):
-            if filename.lower().endswith(img_extensions):
-                file_path = os.path.join(GITEE_IMG_DIR, filename)
-                file_size = os.path.getsize(file_path) / 1024
-                create_time = datetime.fromtimestamp(os.path.getctime(file_path)).strftime('%Y-%m-%d %H:%M:%S')
-                img_list.append({
-                    'filename': filename,
-                    'size': f"{file_size:.2f} KB",
-                    'create_time': create_time,
-                    'url': f'/api/giteeimg/show/{filename}'
-                })
-        img_list.sort(key=lambda x: x['create_time'], reverse=True)
-        return jsonify({"success": True, "data": img_list})
+        limit = max(1, min(request.args.get('limit', 60, type=int), 200))
+        cursor = request.args.get('cursor', '')
+        date = request.args.get('date', '')
+        persona = request.args.get('persona', '')
+        mode = request.args.get('mode', '')
+        
+        conn = gallery_connect()
+        try:
+            version = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+            query_key = f"{version}|{limit}|{cursor}|{date}|{persona}|{mode}"
+            etag = '"' + hashlib.md5(query_key.encode('utf-8')).hexdigest() + '"'
+            if request.headers.get('If-None-Match') == etag:
+                return Response(status=304, headers={'ETag': etag})
+            
+            where, params = [], []
+            if cursor:
+                cursor_time, _, cursor_name = cursor.partition('|')
+                where.append("(created_at < ? OR (created_at = ? AND filename < ?))")
+                params.extend([float(cursor_time), float(cursor_time), cursor_name])
+            if date:
+                day_start = datetime.strptime(date, '%Y-%m-%d').timestamp()
+                where.append("created_at >= ? AND created_at < ?")
+                params.extend([day_start, day_start + 86400])
+            if persona:
+                where.append("persona_id = ?")
+                params.append(persona)
+            if mode:
+                where.append("mode = ?")
+                params.append(mode)
+            
+            sql = "SELECT * FROM images"
+            if where:
+                sql += " WHERE " + " AND ".join(where)
+            sql += " ORDER BY created_at DESC, filename DESC LIMIT ?"
+            rows = conn.execute(sql, params + [limit + 1]).fetchall()
+        finally:
+            conn.close()
+        
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = f"{rows[-1]['created_at']!r}|{rows[-1]['filename']}"
+        
+        response = jsonify({
+            "success": True,
+            "data": [format_image_row(row) for row in rows],
+            "next_cursor": next_cursor
+        })
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except ValueError as e:
+        return jsonify({"success": False, "message": f"参数错误: {str(e)}"}), 400
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500
 
@@ -172,10 +390,60 @@ def delete_giteeimg(filename):
         if not os.path.exists(file_path):
             return jsonify({"success": False, "message": "图片不存在"}), 404
         os.remove(file_path)
+        thumb_path = os.path.join(GITEE_THUMB_DIR, thumb_name(filename))
+        if os.path.exists(thumb_path):
+            os.remove(thumb_path)
+        conn = gallery_connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM images WHERE filename = ?", (filename,))
+        finally:
+            conn.close()
         return jsonify({"success": True, "message": "删除成功"})
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500
 
+def thumb_name(filename):
+    return filename + '.webp'
+
+def ensure_thumbnail(filename):
+    """生成（或复用）缩略图，返回缩略图文件名；无法生成时返回None"""
+    if Image is None:
+        return None
+    source = os.path.join(GITEE_IMG_DIR, filename)
+    name = thumb_name(filename)
+    target = os.path.join(GITEE_THUMB_DIR, name)
+    if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source):
+        return name
+    
+    tmp_target = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        with Image.open(source) as img:
+            img.thumbnail(THUMB_SIZE)
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+            img.save(tmp_target, format='WEBP', quality=80)
+        os.replace(tmp_target, target)
+        return name
+    except Exception as e:
+        print(f"生成缩略图失败: {e}")
+        if os.path.exists(tmp_target):
+            os.remove(tmp_target)
+        return None
+
+@app.route('/api/giteeimg/thumb/<filename>', methods=['GET'])
+def show_giteeimg_thumb(filename):
+    """提供缩略图访问，首次请求时生成；图片文件名唯一，可长期缓存"""
+    if not os.path.exists(os.path.join(GITEE_IMG_DIR, filename)):
+        return jsonify({"success": False, "message": "图片不存在"}), 404
+    name = ensure_thumbnail(filename)
+    if name is None:
+        # 没有Pillow时退回原图
+        return send_from_directory(GITEE_IMG_DIR, filename)
+    response = send_from_directory(GITEE_THUMB_DIR, name, max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
 @app.route('/api/giteeimg/show/<filename>', methods=['GET'])
 def show_giteeimg(filename):
     """提供图片访问"""
@@ -186,12 +454,8 @@ def show_giteeimg(filename):
 def get_flask_logs():
     try:
         if os.path.exists(FLASK_LOG):
-            with open(FLASK_LOG, 'r', encoding='utf-8') as f:
-                content = f.read()
-            lines = content.strip().split('\n')
-            if len(lines) > 100:
-                content = '\n'.join(lines[-100:])
-            return jsonify({"success": True, "logs": content})
+            content, _ = tail_lines(FLASK_LOG, 100)
+            return jsonify({"success": True, "logs": content.strip()})
         else:
             return jsonify({"success": True, "logs": "暂无日志"})
     except Exception as e:
@@ -257,6 +521,10 @@ def personas():
 def logs():
     return send_from_directory(HTML_DIR, 'logs.html')
 
+@app.route('/metrics')
+def metrics_page():
+    return send_from_directory(HTML_DIR, 'metrics.html')
+
 # Gitee图片管理页面
 @app.route('/giteeimg')
 def giteeimg_page():
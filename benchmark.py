@@ -0,0 +1,437 @@
+"""
+YOIMG 离线基准测试
+
+不需要真实API密钥和网络：在进程内启动模拟上游（Gitee文生图/图生图、SiliconFlow润色、
+共享流量池、图片CDN），用合成的消息事件驱动 /yo、/yoyo、/yozero 和 yoyo_draw，
+统计吞吐、延迟分位数、峰值内存和文件描述符数量，用于上线前发现性能回退。
+
+需要在AstrBot的Python环境中运行（能导入 astrbot.api），在插件目录下执行：
+
+    python benchmark.py --requests 200 --concurrency 16
+    python benchmark.py --target yoyo --latency 1.5 --error-rate 0.05 --payload-kb 2048
+    python benchmark.py --target all --shared-pool --json bench_result.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+from unittest import mock
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import main  # noqa: E402
+
+
+POLISH_TEXT = "一个少女站在盛开的樱花树下，阳光透过花瓣洒落在她的发梢。她穿着白色连衣裙，微笑着看向镜头。背景是蓝天和远山，画面柔和明亮。"
+
+
+class MockUpstream:
+    """模拟上游服务：可配置延迟、错误率和图片大小"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.counts: Dict[str, int] = {}
+        self.base_url = ""
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/images/generations", self.generations)
+        app.router.add_post("/v1/images/edits", self.edits)
+        app.router.add_post("/v1/chat/completions", self.chat)
+        app.router.add_post("/pool/", self.shared_pool)
+        app.router.add_get("/cdn/{name}", self.cdn)
+        app.router.add_get("/v1/models", self.models)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def _count(self, route: str):
+        self.counts[route] = self.counts.get(route, 0) + 1
+
+    @staticmethod
+    def _latency(mean: float, jitter: float) -> float:
+        return max(0.0, random.gauss(mean, mean * jitter))
+
+    def _failure(self) -> Optional[web.Response]:
+        """按错误率返回 503/500/429 中的一种"""
+        if random.random() >= self.args.error_rate:
+            return None
+        status = random.choice((503, 500, 429))
+        return web.json_response({"error": "mock failure"}, status=status, headers={"Retry-After": "0"})
+
+    async def _image_response(self, route: str, n: int) -> web.Response:
+        self._count(route)
+        await asyncio.sleep(self._latency(self.args.latency, self.args.jitter))
+        failure = self._failure()
+        if failure:
+            return failure
+        if self.args.ignore_n:
+            n = 1
+        return web.json_response({
+            "data": [{"url": f"{self.base_url}/cdn/{os.urandom(8).hex()}.png"} for _ in range(max(1, n))]
+        })
+
+    async def generations(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        return await self._image_response("generations", int(body.get("n", 1)))
+
+    async def edits(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        return await self._image_response("edits", int(form.get("n", 1)))
+
+    async def shared_pool(self, request: web.Request) -> web.Response:
+        if request.content_type.startswith("multipart/"):
+            n = int((await request.post()).get("n", 1))
+        else:
+            n = int((await request.json()).get("n", 1))
+        return await self._image_response("shared_pool", n)
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        self._count("chat")
+        body = await request.json()
+        await asyncio.sleep(self._latency(self.args.polish_latency, self.args.jitter))
+        failure = self._failure()
+        if failure:
+            return failure
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.args.token_interval * len(POLISH_TEXT) / 8)
+            return web.json_response({"choices": [{"message": {"content": POLISH_TEXT}}]})
+
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        try:
+            for i in range(0, len(POLISH_TEXT), 8):
+                chunk = {"choices": [{"delta": {"content": POLISH_TEXT[i:i + 8]}}]}
+                await resp.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                await asyncio.sleep(self.args.token_interval)
+            await resp.write(b"data: [DONE]\n\n")
+        except ConnectionResetError:
+            # 插件达到字数预算后会提前断开
+            pass
+        return resp
+
+    async def models(self, request: web.Request) -> web.Response:
+        self._count("models")
+        return web.json_response({"data": []})
+
+    async def cdn(self, request: web.Request) -> web.Response:
+        self._count("cdn")
+        await asyncio.sleep(self._latency(self.args.cdn_latency, self.args.jitter))
+        # 每张图内容不同，避免被插件按内容哈希去重
+        return web.Response(body=os.urandom(self.args.payload_kb * 1024), content_type="image/png")
+
+
+class BenchConversations:
+    """模拟会话管理器：每个会话都使用基准测试人格，带一段聊天记录"""
+
+    HISTORY = json.dumps([
+        {"role": "user", "content": "今天天气真好"},
+        {"role": "assistant", "content": "是呀，适合出去走走"},
+        {"role": "user", "content": "给我画一张你的照片吧"}
+    ] * 5, ensure_ascii=False)
+
+    async def get_curr_conversation_id(self, umo: str) -> str:
+        return f"conv-{umo}"
+
+    async def get_conversation(self, umo: str, cid: str):
+        return SimpleNamespace(persona_id="bench", history=self.HISTORY)
+
+
+class BenchContext:
+    """模拟插件上下文，只提供插件用到的部分"""
+
+    def __init__(self):
+        self.conversation_manager = BenchConversations()
+        self.persona_manager = None
+        self.sent = 0
+
+    async def send_message(self, origin: str, chain) -> bool:
+        self.sent += 1
+        return True
+
+
+class BenchEvent:
+    """合成的消息事件"""
+
+    def __init__(self, message_str: str, user_id: str):
+        self.message_str = message_str
+        self.user_id = user_id
+        self.unified_msg_origin = f"bench:FriendMessage:{user_id}"
+        self.sent: List[tuple] = []
+
+    def get_sender_id(self) -> str:
+        return self.user_id
+
+    def is_admin(self) -> bool:
+        return False
+
+    def get_group_id(self) -> str:
+        return ""
+
+    def plain_result(self, text: str) -> tuple:
+        return ("plain", text)
+
+    def chain_result(self, chain: list) -> tuple:
+        return ("chain", chain)
+
+    async def send(self, result: tuple):
+        self.sent.append(result)
+
+
+class ResourceSampler:
+    """后台采样进程的内存和文件描述符数量"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak_fds = 0
+        self.peak_rss_mb = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def fd_count() -> Optional[int]:
+        try:
+            return len(os.listdir("/proc/self/fd"))
+        except OSError:
+            return None
+
+    @staticmethod
+    def rss_mb() -> float:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+        except (OSError, ValueError):
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self):
+        while True:
+            self.peak_fds = max(self.peak_fds, self.fd_count() or 0)
+            self.peak_rss_mb = max(self.peak_rss_mb, self.rss_mb())
+            await asyncio.sleep(self.interval)
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return round(sorted_values[index], 1)
+
+
+async def run_one(plugin: "main.YoYoPlugin", target: str, index: int) -> bool:
+    """执行一次请求，返回是否成功发出了图片"""
+    user_id = f"bench{index}"
+    keyword = f"樱花树下 {index}"
+
+    if target == "llm":
+        event = BenchEvent(keyword, user_id)
+        await plugin.yoyo_llm_tool(event, keyword)
+        return any(kind == "chain" for kind, _ in event.sent)
+
+    if target == "yozero":
+        event = BenchEvent(f"/yozero {keyword}", user_id)
+        results = [r async for r in plugin.txt2img_direct_command(event)]
+    else:
+        event = BenchEvent(f"/{target} {keyword}", user_id)
+        results = [r async for r in plugin._generate_image(event, keyword, is_txt2img=(target == "yo"))]
+    return any(kind == "chain" for kind, _ in results)
+
+
+async def run_target(plugin: "main.YoYoPlugin", target: str, args: argparse.Namespace) -> Dict[str, Any]:
+    latencies: List[float] = []
+    errors = 0
+    next_index = iter(range(args.requests))
+
+    async def worker():
+        nonlocal errors
+        for index in next_index:
+            start = time.perf_counter()
+            try:
+                ok = await run_one(plugin, target, index)
+            except Exception as e:
+                print(f"[{target}] 请求 {index} 异常: {e}", file=sys.stderr)
+                ok = False
+            latencies.append((time.perf_counter() - start) * 1000)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "target": target,
+        "requests": args.requests,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 2),
+        "req_per_s": round(args.requests / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "max_ms": round(latencies[-1], 1) if latencies else 0.0
+    }
+
+
+def build_config(base_url: str, args: argparse.Namespace) -> Dict[str, Any]:
+    return {
+        "api_key": [f"bench-key-{i}" for i in range(args.keys)],
+        "txt2img_endpoint": f"{base_url}/v1/images/generations",
+        "img2img_endpoint": f"{base_url}/v1/images/edits",
+        "sf_base_url": f"{base_url}/v1",
+        "sf_api_key": "bench",
+        "use_polish": not args.no_polish,
+        "polish_stream": not args.no_stream,
+        "polish_max_chars": args.polish_max_chars,
+        "polish_cache_enabled": False,
+        "result_cache_enabled": False,
+        "use_shared_pool": args.shared_pool,
+        "shared_pool_url": f"{base_url}/pool/",
+        "max_concurrency": args.concurrency,
+        "per_key_concurrency": args.per_key_concurrency,
+        "queue_max_size": 0,
+        "llm_async_mode": False,
+        "rate_limit_enabled": False,
+        "startup_warmup": args.warmup,
+        "housekeeping_enabled": False,
+        "retry_base_delay": 0.05,
+        "metrics_flush_interval": 3600,
+        "size": "1024x1024"
+    }
+
+
+def prepare_data_dir(data_dir: Path) -> Path:
+    """写入基准测试人格和形象图"""
+    reference = data_dir / "bench_reference.png"
+    if main.PILImage is not None:
+        main.PILImage.new("RGB", (1536, 1536), (255, 200, 220)).save(reference)
+    else:
+        reference.write_bytes(os.urandom(512 * 1024))
+
+    personas = [{
+        "persona_id": "bench",
+        "png_path": str(reference),
+        "polish_time": time.strftime("%Y/%m/%d %H:%M:%S"),
+        "polished_prompt": "黑色长发的少女，温柔，喜欢摄影"
+    }]
+    with open(data_dir / "personas.json", "w", encoding="utf-8") as f:
+        json.dump(personas, f, ensure_ascii=False)
+    return reference
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    upstream = MockUpstream(args)
+    base_url = await upstream.start()
+    data_dir = Path(tempfile.mkdtemp(prefix="yoimg_bench_"))
+    prepare_data_dir(data_dir)
+
+    sampler = ResourceSampler()
+    report: Dict[str, Any] = {
+        "args": vars(args),
+        "baseline": {"fds": ResourceSampler.fd_count(), "rss_mb": round(ResourceSampler.rss_mb(), 1)},
+        "results": []
+    }
+
+    with mock.patch.object(main.StarTools, "get_data_dir", lambda name: str(data_dir)):
+        plugin = main.YoYoPlugin(BenchContext(), build_config(base_url, args))
+    if plugin._warmup_task is not None:
+        await plugin._warmup_task
+        report["startup"] = plugin.startup_report
+        print(f"启动预热耗时 {plugin.startup_report['duration_ms']}ms，健康: {plugin.startup_report['healthy']}")
+
+    targets = ["yo", "yoyo", "yozero", "llm"] if args.target == "all" else [args.target]
+    sampler.start()
+    try:
+        for target in targets:
+            result = await run_target(plugin, target, args)
+            report["results"].append(result)
+            print(
+                f"{target:>7}: {result['req_per_s']:>7} req/s  "
+                f"p50 {result['p50_ms']:>8}ms  p95 {result['p95_ms']:>8}ms  p99 {result['p99_ms']:>8}ms  "
+                f"错误 {result['errors']}/{result['requests']}"
+            )
+    finally:
+        await sampler.stop()
+        await plugin.terminate()
+        await upstream.stop()
+        if not args.keep:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    report["peak_rss_mb"] = round(sampler.peak_rss_mb, 1)
+    report["peak_fds"] = sampler.peak_fds
+    report["upstream_calls"] = upstream.counts
+    report["stages"] = plugin.metrics.snapshot()["stages"]
+    report["backends"] = plugin.router.snapshot()
+    report["breakers"] = {name: breaker.snapshot() for name, breaker in plugin.breakers.items()}
+
+    print(f"峰值内存 {report['peak_rss_mb']}MB，峰值文件描述符 {report['peak_fds']}（基线 {report['baseline']['fds']}）")
+    print(f"上游调用: {upstream.counts}")
+    for stage, s in report["stages"].items():
+        print(f"  {stage:>12}: p50 {s['p50_ms']:>8}ms  p95 {s['p95_ms']:>8}ms  次数 {s['count']}")
+    if args.keep:
+        print(f"数据目录已保留: {data_dir}")
+    return report
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="YOIMG 离线基准测试")
+    parser.add_argument("--target", choices=["yo", "yoyo", "yozero", "llm", "all"], default="yo",
+                        help="驱动的入口：/yo、/yoyo、/yozero、yoyo_draw，或全部依次执行")
+    parser.add_argument("--requests", type=int, default=100, help="每个入口的请求数")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发数（同时也作为插件的max_concurrency）")
+    parser.add_argument("--keys", type=int, default=4, help="模拟的Gitee密钥数")
+    parser.add_argument("--per-key-concurrency", type=int, default=2, help="单个密钥的并发上限")
+    parser.add_argument("--latency", type=float, default=0.5, help="生图接口平均延迟（秒）")
+    parser.add_argument("--polish-latency", type=float, default=0.2, help="润色接口首字延迟（秒）")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="润色流式输出每段间隔（秒）")
+    parser.add_argument("--cdn-latency", type=float, default=0.05, help="图片CDN延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.2, help="延迟抖动（相对标准差）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="上游返回503/500/429的概率")
+    parser.add_argument("--payload-kb", type=int, default=1024, help="每张图片大小（KB）")
+    parser.add_argument("--ignore-n", action="store_true", help="模拟不支持n参数的模型（总是只返回一张）")
+    parser.add_argument("--shared-pool", action="store_true", help="同时启用共享流量池后端")
+    parser.add_argument("--no-polish", action="store_true", help="关闭润色")
+    parser.add_argument("--no-stream", action="store_true", help="润色不使用流式")
+    parser.add_argument("--polish-max-chars", type=int, default=0, help="润色字数预算")
+    parser.add_argument("--warmup", action="store_true", help="启用插件启动预热（对比冷启动时首批请求的延迟）")
+    parser.add_argument("--json", help="把完整结果写入JSON文件")
+    parser.add_argument("--keep", action="store_true", help="保留临时数据目录（图片、日志）")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,53 @@
+"""图库索引的表结构与历史图片导入，插件（main.py）和管理面板（app.py）共用
+
+只依赖标准库，管理面板的Docker容器中也需要挂载本文件。
+"""
+import os
+import sqlite3
+
+# 图库索引文件名，与图片一起放在 img/ 目录下（Docker部署时该目录已挂载）
+GALLERY_DB_NAME = "gallery.db"
+
+IMG_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+
+GALLERY_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS images (
+        filename TEXT PRIMARY KEY,
+        created_at REAL NOT NULL,
+        size INTEGER NOT NULL,
+        persona_id TEXT,
+        mode TEXT,
+        req_id TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_images_created ON images(created_at DESC, filename DESC);
+    CREATE INDEX IF NOT EXISTS idx_images_persona ON images(persona_id, created_at DESC);
+    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+    INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+    INSERT OR IGNORE INTO meta (key, value) VALUES ('backfilled', 0);
+    CREATE TRIGGER IF NOT EXISTS images_ai AFTER INSERT ON images
+        BEGIN UPDATE meta SET value = value + 1 WHERE key = 'version'; END;
+    CREATE TRIGGER IF NOT EXISTS images_ad AFTER DELETE ON images
+        BEGIN UPDATE meta SET value = value + 1 WHERE key = 'version'; END;
+    CREATE TRIGGER IF NOT EXISTS images_au AFTER UPDATE ON images
+        BEGIN UPDATE meta SET value = value + 1 WHERE key = 'version'; END;
+    CREATE TABLE IF NOT EXISTS image_hashes (sha256 TEXT PRIMARY KEY, filename TEXT NOT NULL);
+    CREATE TRIGGER IF NOT EXISTS images_hash_ad AFTER DELETE ON images
+        BEGIN DELETE FROM image_hashes WHERE filename = OLD.filename; END;
+"""
+
+
+def init_gallery(conn: sqlite3.Connection, image_dir: str):
+    """建表，并在首次使用时把目录中已有的图片导入索引（以meta中的backfilled标记为准，只执行一次）"""
+    conn.executescript(GALLERY_SCHEMA)
+    if conn.execute("SELECT value FROM meta WHERE key = 'backfilled'").fetchone()[0]:
+        return
+
+    rows = []
+    if os.path.isdir(image_dir):
+        for entry in os.scandir(image_dir):
+            if entry.is_file() and entry.name.lower().endswith(IMG_EXTENSIONS):
+                stat = entry.stat()
+                rows.append((entry.name, stat.st_mtime, stat.st_size))
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO images (filename, created_at, size) VALUES (?, ?, ?)", rows)
+        conn.execute("UPDATE meta SET value = 1 WHERE key = 'backfilled'")
@@ -1,8 +1,7 @@
-from astrbot.api.event import filter, AstrMessageEvent, MessageEventResult
+from astrbot.api.event import filter, AstrMessageEvent, MessageEventResult, MessageChain
 from astrbot.api.star import Context, Star, register, StarTools
 from astrbot.api import logger
 from astrbot.api.message_components import Plain, Image
-from openai import AsyncOpenAI
 import aiohttp
 import json
 import time
@@ -11,11 +10,1281 @@ import asyncio
 from pathlib import Path
 import base64
 from typing import Dict, Any, List, Optional
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from collections import deque, OrderedDict
+import hashlib
+import random
 import os
 import re
 import threading
 import subprocess
+import io
+import sqlite3
+import gzip
+import shutil
+import contextvars
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+try:
+    from .gallery_schema import GALLERY_DB_NAME, init_gallery
+except ImportError:
+    # 作为独立模块导入时（如 benchmark.py）
+    from gallery_schema import GALLERY_DB_NAME, init_gallery
+
+
+class KeyCooldownError(Exception):
+    """所有密钥都在限流冷却中，且冷却时间超过可等待的时间"""
+    
+    def __init__(self, retry_in: float):
+        self.retry_in = retry_in
+        super().__init__(f"所有API密钥限流冷却中，约 {max(1, round(retry_in))} 秒后恢复")
+
+
+class ApiKeyPool:
+    """Gitee API密钥池：按轮询或最少并发分配密钥，被限流的密钥进入退避冷却"""
+    
+    RATE_LIMIT_MARKERS = ("rate limit", "too many requests", "quota", "insufficient", "限流", "额度", "余额")
+    
+    def __init__(self, keys, strategy: str = "round_robin", base_cooldown: int = 30, max_cooldown: int = 600,
+                 max_inflight_per_key: int = 0):
+        if not isinstance(keys, list):
+            keys = [keys] if keys else []
+        self.keys = [str(k).strip() for k in keys if str(k).strip()]
+        self.strategy = strategy
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.max_inflight_per_key = max_inflight_per_key
+        self._cursor = 0
+        self._waiters: deque = deque()
+        self.invalid: set = set()
+        self.stats: Dict[str, Dict[str, Any]] = {
+            key: {
+                "requests": 0,
+                "success": 0,
+                "errors": 0,
+                "rate_limited": 0,
+                "in_flight": 0,
+                "strikes": 0,
+                "cooldown_until": 0.0
+            } for key in self.keys
+        }
+    
+    def __bool__(self):
+        return bool(self.keys)
+    
+    def __len__(self):
+        return len(self.keys)
+    
+    async def acquire(self, max_wait: float = 0) -> Optional[str]:
+        """取出一个可用密钥：都达到并发上限时等待归还；都在冷却时最多等待max_wait秒，
+        冷却时间更长则抛出KeyCooldownError，由调用方转移到其他后端"""
+        if not self.keys:
+            return None
+        
+        deadline = time.time() + max_wait
+        while True:
+            key = self._pick()
+            if key is not None:
+                break
+            
+            now = time.time()
+            usable = self._usable()
+            cooling_for = min(self.stats[k]["cooldown_until"] for k in usable) - now
+            if cooling_for > 0 and now + cooling_for > deadline:
+                raise KeyCooldownError(cooling_for)
+            
+            # 有空闲并发但都在冷却时，等到最早解除冷却；否则等待密钥归还
+            free = [k for k in usable if self._has_slot(k)]
+            timeout = min(self.stats[k]["cooldown_until"] for k in free) - now if free else None
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        
+        stat = self.stats[key]
+        stat["requests"] += 1
+        stat["in_flight"] += 1
+        return key
+    
+    def mark_invalid(self, key: str):
+        """标记校验失败或被上游拒绝的密钥，不再分配（全部无效时仍照常分配，让请求返回具体错误）"""
+        if key in self.stats:
+            self.invalid.add(key)
+    
+    def valid_count(self) -> int:
+        return len(self.keys) - len(self.invalid)
+    
+    def _usable(self) -> List[str]:
+        return [k for k in self.keys if k not in self.invalid] or self.keys
+    
+    def _has_slot(self, key: str) -> bool:
+        return self.max_inflight_per_key <= 0 or self.stats[key]["in_flight"] < self.max_inflight_per_key
+    
+    def _pick(self) -> Optional[str]:
+        """按策略选择未冷却且未达到并发上限的密钥，没有时返回None"""
+        now = time.time()
+        available = [k for k in self._usable() if self._has_slot(k) and self.stats[k]["cooldown_until"] <= now]
+        if not available:
+            key = None
+        elif self.strategy == "least_inflight":
+            key = min(available, key=lambda k: (self.stats[k]["in_flight"], self.stats[k]["requests"]))
+        else:
+            key = None
+            for _ in range(len(self.keys)):
+                candidate = self.keys[self._cursor % len(self.keys)]
+                self._cursor += 1
+                if candidate in available:
+                    key = candidate
+                    break
+        return key
+    
+    def release(self, key: Optional[str], status: Optional[int] = None, error: str = ""):
+        """归还密钥并记录本次调用结果"""
+        if key not in self.stats:
+            return
+        
+        stat = self.stats[key]
+        stat["in_flight"] = max(0, stat["in_flight"] - 1)
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+        
+        if status == 200 and not error:
+            stat["success"] += 1
+            stat["strikes"] = 0
+        elif self.is_rate_limited(status, error):
+            stat["rate_limited"] += 1
+            stat["strikes"] += 1
+            cooldown = min(self.base_cooldown * (2 ** (stat["strikes"] - 1)), self.max_cooldown)
+            stat["cooldown_until"] = time.time() + cooldown
+            logger.warning("API密钥 %s 被限流，冷却 %s 秒", self.mask(key), cooldown)
+        elif status in (401, 403):
+            stat["errors"] += 1
+            if key not in self.invalid:
+                self.invalid.add(key)
+                logger.warning("API密钥 %s 被上游拒绝（HTTP %s），不再分配", self.mask(key), status)
+        else:
+            stat["errors"] += 1
+    
+    @classmethod
+    def is_rate_limited(cls, status: Optional[int], error: str = "") -> bool:
+        """判断是否为限流/额度错误"""
+        if status == 429:
+            return True
+        error_lower = (error or "").lower()
+        return any(marker in error_lower for marker in cls.RATE_LIMIT_MARKERS)
+    
+    def available_count(self) -> int:
+        """未处于冷却且未达到并发上限的密钥数"""
+        now = time.time()
+        return sum(1 for key in self._usable() if self.stats[key]["cooldown_until"] <= now and self._has_slot(key))
+    
+    @staticmethod
+    def mask(key: str) -> str:
+        """密钥脱敏"""
+        if len(key) <= 8:
+            return "*" * len(key)
+        return f"{key[:4]}...{key[-4:]}"
+    
+    def report(self) -> List[Dict[str, Any]]:
+        """各密钥使用统计"""
+        now = time.time()
+        return [
+            {
+                "key": self.mask(key),
+                "requests": stat["requests"],
+                "success": stat["success"],
+                "errors": stat["errors"],
+                "rate_limited": stat["rate_limited"],
+                "in_flight": stat["in_flight"],
+                "invalid": key in self.invalid,
+                "cooldown_remaining": max(0, int(stat["cooldown_until"] - now))
+            } for key, stat in self.stats.items()
+        ]
+
+
+class AsyncLogWriter:
+    """后台日志写入：记录经有界队列缓冲，由后台任务批量落盘，并按大小或按天轮转"""
+    
+    def __init__(self, log_dir: Path, max_queue: int = 1000, batch_size: int = 200,
+                 rotate_mode: str = "size", max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5):
+        self.log_dir = log_dir
+        self.batch_size = batch_size
+        self.rotate_mode = rotate_mode
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.dropped = 0
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._task: Optional[asyncio.Task] = None
+    
+    def write(self, filename: str, record: Dict[str, Any]):
+        """提交一条日志记录，队列已满时丢弃并计数，不阻塞事件循环"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write_batch([(filename, record)])
+            return
+        
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        try:
+            self._queue.put_nowait((filename, record))
+        except asyncio.QueueFull:
+            self.dropped += 1
+    
+    async def close(self):
+        """写完队列中剩余的记录后停止后台任务"""
+        if self._task is None or self._task.done():
+            return
+        await self._queue.put(None)
+        await self._task
+        if self.dropped:
+            logger.warning("日志队列溢出，共丢弃 %s 条日志", self.dropped)
+    
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            
+            batch = [item]
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            
+            try:
+                await asyncio.to_thread(self._write_batch, batch)
+            except Exception as e:
+                logger.error("写入日志失败: %s", str(e))
+            if stop:
+                return
+    
+    def _write_batch(self, batch: List[tuple]):
+        """按文件分组一次性写入（在线程池中执行）"""
+        grouped: Dict[str, List[str]] = {}
+        for filename, record in batch:
+            grouped.setdefault(filename, []).append(json.dumps(record, ensure_ascii=False) + '\n')
+        
+        for filename, lines in grouped.items():
+            log_file = self.log_dir / filename
+            self._rotate_if_needed(log_file)
+            with open(log_file, 'a', encoding='utf-8') as f:
+                f.write(''.join(lines))
+    
+    def _rotate_if_needed(self, log_file: Path):
+        """按大小或按天轮转日志文件，历史段按时间命名（.YYYYmmdd-HHMMSS / .YYYY-MM-DD）"""
+        try:
+            stat = log_file.stat()
+        except FileNotFoundError:
+            return
+        
+        if self.rotate_mode == "daily":
+            suffix = datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d")
+            if suffix == datetime.now().strftime("%Y-%m-%d"):
+                return
+        else:
+            if self.max_bytes <= 0 or stat.st_size < self.max_bytes:
+                return
+            suffix = datetime.now().strftime("%Y%m%d-%H%M%S")
+        
+        if self.backup_count <= 0:
+            log_file.unlink(missing_ok=True)
+            return
+        
+        target = log_file.with_name(f"{log_file.name}.{suffix}")
+        index = 1
+        while target.exists() or target.with_name(target.name + ".gz").exists():
+            target = log_file.with_name(f"{log_file.name}.{suffix}.{index}")
+            index += 1
+        os.replace(log_file, target)
+        
+        for old in self.list_segments(log_file)[:-self.backup_count]:
+            old.unlink(missing_ok=True)
+    
+    @staticmethod
+    def list_segments(log_file: Path) -> List[Path]:
+        """列出已轮转的历史日志段（含压缩后的.gz），按修改时间从旧到新排序"""
+        segments = [
+            p for p in log_file.parent.glob(f"{log_file.name}.*")
+            if not p.name.endswith(".tmp")
+        ]
+        return sorted(segments, key=lambda p: p.stat().st_mtime)
+
+
+class CircuitOpenError(Exception):
+    """上游处于熔断状态，请求被直接拒绝"""
+
+
+class CircuitBreaker:
+    """上游熔断器：连续失败达到阈值后熔断，冷却期内直接失败，冷却结束后放行一个探测请求"""
+    
+    STATES = {"closed": 0, "half_open": 1, "open": 2}
+    
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: int = 60, on_change=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.on_change = on_change
+        self.state = "closed"
+        self.failures = 0
+        self.total_failures = 0
+        self.rejected = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+    
+    def allow(self) -> bool:
+        """是否放行本次请求"""
+        if self.failure_threshold <= 0:
+            return True
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                self.rejected += 1
+                return False
+            self._set_state("half_open")
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                self.rejected += 1
+                return False
+            self._probe_in_flight = True
+        return True
+    
+    def record_success(self):
+        self.failures = 0
+        self._probe_in_flight = False
+        if self.state != "closed":
+            self._set_state("closed")
+    
+    def record_failure(self):
+        self.failures += 1
+        self.total_failures += 1
+        self._probe_in_flight = False
+        if self.state == "half_open" or (self.failure_threshold > 0 and self.failures >= self.failure_threshold):
+            self.opened_at = time.monotonic()
+            if self.state != "open":
+                self._set_state("open")
+    
+    def is_available(self) -> bool:
+        """不改变状态地判断当前是否会放行请求"""
+        if self.failure_threshold <= 0 or self.state == "closed":
+            return True
+        if self.state == "open":
+            return time.monotonic() - self.opened_at >= self.recovery_timeout
+        return not self._probe_in_flight
+    
+    def cancel_probe(self):
+        """请求未得出结果（被取消或本地异常）时释放探测名额"""
+        self._probe_in_flight = False
+    
+    def retry_in(self) -> int:
+        """距离下次放行探测请求的秒数"""
+        if self.state != "open":
+            return 0
+        return max(0, int(self.recovery_timeout - (time.monotonic() - self.opened_at)))
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "total_failures": self.total_failures,
+            "rejected": self.rejected,
+            "retry_in": self.retry_in()
+        }
+    
+    def _set_state(self, state: str):
+        old_state, self.state = self.state, state
+        if self.on_change:
+            self.on_change(self, old_state)
+
+
+class BackendRouter:
+    """生图后端路由：按观测到的延迟、错误率在直连Gitee与共享流量池之间排序，失败时按顺序转移"""
+    
+    def __init__(self, backends: List[str], window: int = 20, error_threshold: float = 0.5,
+                 weights: Optional[Dict[str, float]] = None, ewma_alpha: float = 0.3, explore_ratio: float = 0.05):
+        self.error_threshold = error_threshold
+        self.explore_ratio = explore_ratio
+        self.weights = weights or {}
+        self.ewma_alpha = ewma_alpha
+        self.stats: Dict[str, Dict[str, Any]] = {
+            name: {
+                "latency_ms": None,
+                "results": deque(maxlen=window),
+                "in_flight": 0,
+                "served": 0,
+                "failovers": 0
+            } for name in backends
+        }
+    
+    def error_rate(self, backend: str) -> float:
+        results = self.stats[backend]["results"]
+        return round(1 - sum(results) / len(results), 3) if results else 0.0
+    
+    def cost(self, backend: str) -> float:
+        """预计代价：平滑延迟 × 错误率惩罚 × 偏好权重，错误率超过阈值的后端排到最后；
+        没有调用记录时为0，优先试探；调用过但从未成功时排在有成功记录的后端之后"""
+        stat = self.stats[backend]
+        error_rate = self.error_rate(backend)
+        if stat["latency_ms"] is None:
+            cost = 1e6 * error_rate
+        else:
+            cost = stat["latency_ms"] * (1 + 2 * error_rate) * (1 + stat["in_flight"] * 0.1)
+            cost *= self.weights.get(backend, 1.0)
+        if error_rate >= self.error_threshold:
+            cost += 1e9
+        return cost
+    
+    def rank(self, candidates: List[str]) -> List[str]:
+        """按代价排序；少量请求交换前两位，让较慢的后端也能刷新延迟和错误率"""
+        order = sorted(candidates, key=self.cost)
+        if len(order) > 1 and random.random() < self.explore_ratio:
+            order[0], order[1] = order[1], order[0]
+        return order
+    
+    def begin(self, backend: str):
+        self.stats[backend]["in_flight"] += 1
+    
+    def end(self, backend: str, success: bool, latency_ms: float, failover: bool = False):
+        """记录一次调用结果；成功时才更新延迟，避免快速失败拉低延迟估计"""
+        stat = self.stats[backend]
+        stat["in_flight"] = max(0, stat["in_flight"] - 1)
+        stat["results"].append(success)
+        if failover:
+            stat["failovers"] += 1
+        if success:
+            stat["served"] += 1
+            if stat["latency_ms"] is None:
+                stat["latency_ms"] = latency_ms
+            else:
+                stat["latency_ms"] += self.ewma_alpha * (latency_ms - stat["latency_ms"])
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            name: {
+                "latency_ms": round(stat["latency_ms"], 1) if stat["latency_ms"] is not None else None,
+                "error_rate": self.error_rate(name),
+                "in_flight": stat["in_flight"],
+                "served": stat["served"],
+                "failovers": stat["failovers"]
+            } for name, stat in self.stats.items()
+        }
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数：中日韩字符按1个token，其余约4个字符1个token"""
+    cjk = sum(1 for ch in text if ch >= "\u2e80")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class ChatHistoryExtractor:
+    """聊天记录尾部提取：只解析history末尾的若干条消息，按字数或估算token数截断，并按会话缓存结果
+    
+    history是消息对象组成的JSON数组，从字符串末尾向前定位 {"role": 开头的对象逐个解码，
+    不必对整段历史执行json.loads；格式不符合预期时回退到完整解析。
+    """
+    
+    MESSAGE_START = re.compile(r'\{\s*"role"\s*:')
+    
+    def __init__(self, max_messages: int = 15, budget: int = 1200, unit: str = "char", cache_size: int = 256):
+        self.max_messages = max_messages
+        self.budget = budget
+        self.unit = unit
+        self.cache_size = cache_size
+        self._cache: OrderedDict = OrderedDict()  # 会话ID -> (history长度, 提取结果)
+        self._lock = threading.Lock()  # extract在线程池中执行，多个线程同时读写缓存
+        self._decoder = json.JSONDecoder()
+    
+    def extract(self, history, conversation_id: Optional[str] = None) -> str:
+        if not history:
+            return ""
+        
+        if conversation_id and isinstance(history, str):
+            with self._lock:
+                cached = self._cache.get(conversation_id)
+                if cached and cached[0] == len(history):
+                    self._cache.move_to_end(conversation_id)
+                    return cached[1]
+        
+        try:
+            if isinstance(history, list):
+                messages = history[-self.max_messages:] if self.max_messages > 0 else history
+            else:
+                messages = self._tail_messages(history)
+            text = self._render(messages)
+        except Exception:
+            return ""
+        
+        if conversation_id and isinstance(history, str):
+            with self._lock:
+                self._cache[conversation_id] = (len(history), text)
+                self._cache.move_to_end(conversation_id)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return text
+    
+    def _tail_messages(self, history: str) -> list:
+        """从末尾向前解码消息，窗口内凑不够预算时扩大窗口，找不到消息边界时回退到完整解析"""
+        window = max(4096, self.budget * 8)
+        while True:
+            start = max(0, len(history) - window)
+            messages = self._decode_tail(history, start)
+            if messages is None:
+                break
+            enough = (self.max_messages > 0 and len(messages) >= self.max_messages) or (
+                self.budget > 0 and sum(self._cost("".join(p)) for p in map(self._message_parts, messages) if p) >= self.budget
+            )
+            if enough or start == 0:
+                return messages
+            window *= 4
+        
+        data = json.loads(history)
+        if not isinstance(data, list):
+            return []
+        return data[-self.max_messages:] if self.max_messages > 0 else data
+    
+    def _decode_tail(self, history: str, start: int) -> Optional[list]:
+        """解码history[start:]中首尾相接、一直到数组结尾的消息对象（按时间顺序返回）"""
+        end_bracket = history.rstrip().rfind("]")
+        if end_bracket < 0 or history[end_bracket + 1:].strip():
+            return None
+        
+        candidates = [m.start() for m in self.MESSAGE_START.finditer(history, start)]
+        if not candidates:
+            return None if start == 0 else []
+        
+        messages = []
+        boundary = end_bracket
+        for pos in reversed(candidates):
+            try:
+                obj, end = self._decoder.raw_decode(history, pos)
+            except ValueError:
+                continue
+            separator = history[end:boundary].strip()
+            if separator not in ("", ",") or not isinstance(obj, dict):
+                continue  # 嵌套在消息内部的对象
+            messages.append(obj)
+            boundary = pos
+            if self.max_messages > 0 and len(messages) >= self.max_messages:
+                break
+        messages.reverse()
+        return messages
+    
+    @staticmethod
+    def _content_text(msg: Dict) -> str:
+        content = msg.get("content", "")
+        if isinstance(content, list):
+            # 多模态消息只取文本部分
+            return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+        return content if isinstance(content, str) else ""
+    
+    def _message_parts(self, msg) -> Optional[tuple]:
+        """会进入提取结果的消息返回 (前缀, 正文)：只保留有文本内容的用户(A)和助手(B)消息"""
+        if not isinstance(msg, dict) or msg.get("role") not in ("user", "assistant"):
+            return None
+        content = self._content_text(msg)
+        if not content:
+            return None
+        return ("A" if msg["role"] == "user" else "B"), content
+    
+    def _cost(self, text: str) -> int:
+        """按字数或估算token数计算长度"""
+        return estimate_tokens(text) if self.unit == "token" else len(text)
+    
+    def _render(self, messages: list) -> str:
+        """从最新一条向前拼接 A(用户)/B(助手) 前缀的消息，超出预算时截取最早那条的末尾"""
+        parts = []
+        remaining = self.budget
+        for msg in reversed(messages):
+            message_parts = self._message_parts(msg)
+            if not message_parts:
+                continue
+            prefix, content = message_parts
+            if self.budget > 0:
+                cost = self._cost(prefix + content)
+                if cost > remaining:
+                    tail = self._fit_tail(content, remaining - 1)
+                    if tail:
+                        parts.append(prefix + tail)
+                    break
+                remaining -= cost
+            parts.append(prefix + content)
+        parts.reverse()
+        return "".join(parts)
+    
+    def _fit_tail(self, text: str, budget: int) -> str:
+        """截取text末尾不超过预算的部分"""
+        if budget <= 0:
+            return ""
+        if self.unit != "token":
+            return text[-budget:]
+        used = 0.0
+        for i in range(len(text) - 1, -1, -1):
+            used += 1 if text[i] >= "\u2e80" else 0.25
+            if used > budget:
+                return text[i + 1:]
+        return text
+
+
+class QuotaLimiter:
+    """生图限额：令牌桶限制突发频率，按自然小时/自然日计数限制总量；状态可持久化，重启后继续生效
+    
+    limits按范围类型配置，例如 {"user": {"burst": 3, "per_minute": 2, "hourly": 20, "daily": 100}}，
+    值为0表示该项不限制。
+    """
+    
+    def __init__(self, limits: Dict[str, Dict[str, float]], persist_file: Optional[Path] = None):
+        self.limits = limits
+        self.persist_file = persist_file
+        self.dirty = False
+        self._buckets: Dict[str, list] = {}   # key -> [剩余令牌, 更新时间, 范围类型]
+        self._counters: Dict[str, list] = {}  # key -> [小时窗口, 小时计数, 日窗口, 日计数]
+        self._load()
+    
+    @staticmethod
+    def _windows(now: float) -> tuple:
+        return int(now // 3600), datetime.fromtimestamp(now).toordinal()
+    
+    def _tokens(self, key: str, limit: Dict[str, float], now: float) -> float:
+        tokens, updated_at = self._buckets.get(key, (limit["burst"], now))[:2]
+        return min(limit["burst"], tokens + (now - updated_at) * limit["per_minute"] / 60)
+    
+    def _counter(self, key: str, now: float) -> list:
+        hour, day = self._windows(now)
+        counter = self._counters.get(key) or [hour, 0, day, 0]
+        if counter[0] != hour:
+            counter[0], counter[1] = hour, 0
+        if counter[2] != day:
+            counter[2], counter[3] = day, 0
+        return counter
+    
+    def check(self, scopes: List[tuple], cost: int = 1) -> Optional[Dict[str, Any]]:
+        """检查所有范围 [(类型, 键)]，超限时返回 {"kind", "period", "limit", "retry_after"}"""
+        now = time.time()
+        for kind, key in scopes:
+            limit = self.limits.get(kind)
+            if not limit:
+                continue
+            
+            counter = self._counter(key, now)
+            if limit.get("daily") and counter[3] + cost > limit["daily"]:
+                tomorrow = datetime.fromordinal(counter[2] + 1).timestamp()
+                return {"kind": kind, "period": "daily", "limit": limit["daily"], "retry_after": tomorrow - now}
+            if limit.get("hourly") and counter[1] + cost > limit["hourly"]:
+                return {"kind": kind, "period": "hourly", "limit": limit["hourly"],
+                        "retry_after": (counter[0] + 1) * 3600 - now}
+            
+            if limit.get("burst") and limit.get("per_minute"):
+                need = min(cost, limit["burst"])
+                tokens = self._tokens(key, limit, now)
+                if tokens < need:
+                    return {"kind": kind, "period": "burst", "limit": limit["burst"],
+                            "retry_after": (need - tokens) * 60 / limit["per_minute"]}
+        return None
+    
+    def acquire(self, scopes: List[tuple], cost: int = 1) -> Optional[Dict[str, Any]]:
+        """所有范围都未超限时扣除额度并返回None，否则不扣除并返回超限信息"""
+        denied = self.check(scopes, cost)
+        if denied:
+            return denied
+        
+        now = time.time()
+        for kind, key in scopes:
+            limit = self.limits.get(kind)
+            if not limit:
+                continue
+            counter = self._counter(key, now)
+            counter[1] += cost
+            counter[3] += cost
+            self._counters[key] = counter
+            if limit.get("burst") and limit.get("per_minute"):
+                self._buckets[key] = [max(0.0, self._tokens(key, limit, now) - min(cost, limit["burst"])), now, kind]
+        self.dirty = True
+        return None
+    
+    def refund(self, scopes: List[tuple], cost: int):
+        """生成失败时退回计数（令牌不退回，仍然限制重试频率）"""
+        if cost <= 0:
+            return
+        now = time.time()
+        for _, key in scopes:
+            if key in self._counters:
+                counter = self._counter(key, now)
+                counter[1] = max(0, counter[1] - cost)
+                counter[3] = max(0, counter[3] - cost)
+        self.dirty = True
+    
+    def usage(self, kind: str, key: str) -> Dict[str, Any]:
+        """某个范围本小时/今天已用的数量和上限"""
+        counter = self._counter(key, time.time())
+        limit = self.limits.get(kind) or {}
+        return {
+            "hourly": counter[1],
+            "hourly_limit": limit.get("hourly", 0),
+            "daily": counter[3],
+            "daily_limit": limit.get("daily", 0)
+        }
+    
+    def snapshot(self) -> str:
+        """清理过期记录并返回要保存的JSON（在事件循环线程调用，与acquire/refund不会交错）
+        
+        只保留今天的计数和尚未回满的令牌桶，回满的桶与初始状态相同。
+        """
+        now = time.time()
+        _, today = self._windows(now)
+        self._buckets = {
+            k: v for k, v in self._buckets.items()
+            if len(v) > 2 and self.limits.get(v[2]) and self._tokens(k, self.limits[v[2]], now) < self.limits[v[2]]["burst"]
+        }
+        self._counters = {k: v for k, v in self._counters.items() if v[2] == today}
+        self.dirty = False
+        return json.dumps({"buckets": self._buckets, "counters": self._counters}, separators=(",", ":"))
+    
+    def write(self, data: str):
+        """原子写入snapshot()返回的内容（可在线程池中执行）"""
+        if not self.persist_file:
+            return
+        tmp_file = self.persist_file.with_name(self.persist_file.name + ".tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_file, self.persist_file)
+    
+    def _load(self):
+        if not self.persist_file or not self.persist_file.exists():
+            return
+        try:
+            with open(self.persist_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self._buckets = data.get("buckets", {})
+            self._counters = data.get("counters", {})
+        except Exception as e:
+            logger.error("加载限额记录失败: %s", str(e))
+
+
+class TTLCache:
+    """通用缓存：按请求内容哈希寻址，LRU淘汰 + TTL过期，可持久化到磁盘（用于润色结果和生图结果）"""
+    
+    def __init__(self, max_size: int = 256, ttl: int = 600, persist_file: Optional[Path] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist_file = persist_file
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._load()
+    
+    @staticmethod
+    def make_key(*parts: str) -> str:
+        """根据请求内容生成缓存键"""
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\x00')
+        return digest.hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at < time.time():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key: str, value: str):
+        self._entries[key] = (value, time.time() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+    
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0
+        }
+    
+    def save(self):
+        """写入磁盘（仅保存未过期的条目）"""
+        if not self.persist_file:
+            return
+        now = time.time()
+        data = [[k, v, exp] for k, (v, exp) in self._entries.items() if exp >= now]
+        tmp_file = self.persist_file.with_name(self.persist_file.name + ".tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_file, self.persist_file)
+    
+    def _load(self):
+        if not self.persist_file or not self.persist_file.exists():
+            return
+        try:
+            with open(self.persist_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            now = time.time()
+            for key, value, expires_at in data[-self.max_size:]:
+                if expires_at >= now:
+                    self._entries[key] = (value, expires_at)
+        except Exception as e:
+            logger.error("加载缓存文件 %s 失败: %s", self.persist_file.name, str(e))
+
+
+class PersonaStore:
+    """人格数据内存索引：按persona_id查找，文件被外部（如管理面板）修改后自动重新加载"""
+    
+    def __init__(self, personas_file: Path, check_interval: float = 2.0):
+        self.personas_file = personas_file
+        self.check_interval = check_interval
+        self.personas: List[Dict] = []
+        self._index: Dict[str, Dict] = {}
+        self._signature: Optional[tuple] = None
+        self._last_check = 0.0
+        self.refresh(force=True)
+    
+    def get(self, persona_id: str) -> Optional[Dict]:
+        """查找指定人格"""
+        self.refresh()
+        return self._index.get(persona_id)
+    
+    def upsert(self, entry: Dict) -> Dict:
+        """新增或更新人格条目"""
+        self.refresh()
+        existing = self._index.get(entry["persona_id"])
+        if existing:
+            existing.update(entry)
+            return existing
+        self.personas.append(entry)
+        self._index[entry["persona_id"]] = entry
+        return entry
+    
+    def refresh(self, force: bool = False):
+        """文件的修改时间或大小变化时重新加载"""
+        now = time.monotonic()
+        if not force and now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        
+        signature = self._file_signature()
+        if not force and signature == self._signature:
+            return
+        
+        personas: List[Dict] = []
+        try:
+            if signature is not None:
+                with open(self.personas_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if isinstance(data, list):
+                    personas = data
+        except Exception as e:
+            logger.error("加载人格数据失败: %s", str(e))
+            return
+        
+        self.personas = personas
+        self._index = {p.get("persona_id"): p for p in personas if p.get("persona_id")}
+        self._signature = signature
+    
+    def save(self):
+        """原子写回文件：先写临时文件再重命名"""
+        tmp_file = self.personas_file.with_name(self.personas_file.name + ".tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.personas, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, self.personas_file)
+        self._signature = self._file_signature()
+    
+    def _file_signature(self) -> Optional[tuple]:
+        try:
+            stat = self.personas_file.stat()
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+
+class ReferenceImageCache:
+    """图生图形象图预处理缓存：按 (路径, 修改时间, 文件大小, 目标尺寸) 缓存缩放后的图片字节"""
+    
+    CONTENT_TYPES = {
+        '.jpg': 'image/jpeg',
+        '.jpeg': 'image/jpeg',
+        '.png': 'image/png',
+        '.gif': 'image/gif',
+        '.webp': 'image/webp'
+    }
+    
+    def __init__(self, max_entries: int = 16, optimize: bool = True, jpeg_quality: int = 90):
+        self.max_entries = max_entries
+        self.optimize = optimize and PILImage is not None
+        self.jpeg_quality = jpeg_quality
+        self._entries: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, image_path: Path, size: str) -> Dict[str, Any]:
+        """取得预处理后的形象图（在线程池中执行），文件不存在时抛出FileNotFoundError"""
+        stat = image_path.stat()
+        key = (str(image_path), stat.st_mtime_ns, stat.st_size, size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        
+        entry = self._prepare(image_path, size)
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+    
+    def _prepare(self, image_path: Path, size: str) -> Dict[str, Any]:
+        raw = image_path.read_bytes()
+        entry = {
+            "path": str(image_path),
+            "name": image_path.name,
+            "data": raw,
+            "content_type": self.CONTENT_TYPES.get(image_path.suffix.lower(), 'application/octet-stream'),
+            "original_size": len(raw),
+            "sha256": hashlib.sha256(raw).hexdigest()
+        }
+        if not self.optimize:
+            return entry
+        
+        try:
+            target_w, target_h = (int(v) for v in size.lower().split("x"))
+        except ValueError:
+            return entry
+        
+        try:
+            with PILImage.open(io.BytesIO(raw)) as img:
+                if getattr(img, "is_animated", False):
+                    return entry
+                if img.width <= target_w and img.height <= target_h and len(raw) <= 2 * 1024 * 1024:
+                    return entry
+                
+                img.thumbnail((target_w, target_h))
+                has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+                buffer = io.BytesIO()
+                if has_alpha:
+                    img.save(buffer, format="PNG", optimize=True)
+                    suffix, content_type = ".png", "image/png"
+                else:
+                    img.convert("RGB").save(buffer, format="JPEG", quality=self.jpeg_quality)
+                    suffix, content_type = ".jpg", "image/jpeg"
+        except Exception as e:
+            logger.warning("形象图预处理失败，使用原图: %s", str(e))
+            return entry
+        
+        data = buffer.getvalue()
+        if len(data) >= len(raw):
+            return entry
+        entry.update({
+            "name": image_path.stem + suffix,
+            "data": data,
+            "content_type": content_type
+        })
+        return entry
+
+
+class MetricsRegistry:
+    """性能指标：各阶段耗时直方图、按api_type统计的成功/失败次数和队列深度"""
+    
+    BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 20000, 30000, 60000, 120000, 180000)
+    
+    def __init__(self, sample_size: int = 1000):
+        self.sample_size = sample_size
+        self.started_at = time.time()
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self.calls: Dict[str, Dict[str, int]] = {}
+    
+    def observe(self, stage: str, duration_ms: float):
+        """记录一次阶段耗时（毫秒）"""
+        hist = self.stages.get(stage)
+        if hist is None:
+            hist = {
+                "count": 0,
+                "sum": 0.0,
+                "buckets": [0] * (len(self.BUCKETS_MS) + 1),
+                "samples": deque(maxlen=self.sample_size)
+            }
+            self.stages[stage] = hist
+        hist["count"] += 1
+        hist["sum"] += duration_ms
+        hist["samples"].append(duration_ms)
+        for i, bound in enumerate(self.BUCKETS_MS):
+            if duration_ms <= bound:
+                hist["buckets"][i] += 1
+                break
+        else:
+            hist["buckets"][-1] += 1
+    
+    def count_call(self, api_type: str, success: bool):
+        """记录一次上游调用结果"""
+        counter = self.calls.setdefault(api_type, {"success": 0, "error": 0})
+        counter["success" if success else "error"] += 1
+    
+    def percentile(self, stage: str, q: float) -> float:
+        """某阶段最近采样的分位数（毫秒），没有数据时返回0"""
+        hist = self.stages.get(stage)
+        return self._percentile(sorted(hist["samples"]), q) if hist else 0.0
+    
+    @staticmethod
+    def _percentile(sorted_samples: List[float], q: float) -> float:
+        if not sorted_samples:
+            return 0.0
+        index = min(len(sorted_samples) - 1, int(round(q * (len(sorted_samples) - 1))))
+        return round(sorted_samples[index], 1)
+    
+    def snapshot(self, gauges: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+        """JSON格式的指标快照，分位数基于最近的采样"""
+        stages = {}
+        for stage, hist in self.stages.items():
+            samples = sorted(hist["samples"])
+            stages[stage] = {
+                "count": hist["count"],
+                "avg_ms": round(hist["sum"] / hist["count"], 1) if hist["count"] else 0.0,
+                "p50_ms": self._percentile(samples, 0.50),
+                "p95_ms": self._percentile(samples, 0.95),
+                "p99_ms": self._percentile(samples, 0.99),
+                "max_ms": round(samples[-1], 1) if samples else 0.0
+            }
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "uptime_seconds": int(time.time() - self.started_at),
+            "stages": stages,
+            "calls": self.calls,
+            "gauges": gauges or {}
+        }
+    
+    def to_prometheus(self, gauges: Optional[Dict[str, float]] = None) -> str:
+        """Prometheus文本格式"""
+        lines = [
+            "# HELP yoimg_stage_duration_ms Stage latency in milliseconds",
+            "# TYPE yoimg_stage_duration_ms histogram"
+        ]
+        for stage, hist in self.stages.items():
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS_MS, hist["buckets"]):
+                cumulative += count
+                lines.append(f'yoimg_stage_duration_ms_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'yoimg_stage_duration_ms_bucket{{stage="{stage}",le="+Inf"}} {hist["count"]}')
+            lines.append(f'yoimg_stage_duration_ms_sum{{stage="{stage}"}} {round(hist["sum"], 1)}')
+            lines.append(f'yoimg_stage_duration_ms_count{{stage="{stage}"}} {hist["count"]}')
+        
+        lines.append("# HELP yoimg_api_calls_total Upstream calls by api_type and result")
+        lines.append("# TYPE yoimg_api_calls_total counter")
+        for api_type, counter in self.calls.items():
+            for result, value in counter.items():
+                lines.append(f'yoimg_api_calls_total{{api_type="{api_type}",result="{result}"}} {value}')
+        
+        for name, value in (gauges or {}).items():
+            lines.append(f"# TYPE yoimg_{name} gauge")
+            lines.append(f"yoimg_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class GalleryIndex:
+    """生成图片索引（SQLite），供管理面板分页查询，避免每次遍历图片目录"""
+    
+    def __init__(self, db_file: Path, image_dir: Path):
+        self.db_file = db_file
+        with self._connect() as conn:
+            init_gallery(conn, str(image_dir))
+    
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_file, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+    
+    def add(self, image_path: Path, persona_id: Optional[str], mode: str, req_id: str,
+            sha256: Optional[str] = None):
+        """登记一张新图片（在线程池中执行）"""
+        stat = image_path.stat()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO images (filename, created_at, size, persona_id, mode, req_id) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (image_path.name, stat.st_mtime, stat.st_size, persona_id, mode, req_id)
+            )
+            if sha256:
+                conn.execute(
+                    "INSERT OR REPLACE INTO image_hashes (sha256, filename) VALUES (?, ?)",
+                    (sha256, image_path.name)
+                )
+    
+    def find_by_hash(self, sha256: str) -> Optional[str]:
+        """按内容哈希查找已登记的图片文件名（在线程池中执行）"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT filename FROM image_hashes WHERE sha256 = ?", (sha256,)).fetchone()
+        return row[0] if row else None
+    
+    def remove(self, filenames: List[str]):
+        """移除图片记录（在线程池中执行）"""
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM images WHERE filename = ?", [(name,) for name in filenames])
+
+
+# 批量生成的张数写法："x4" / "×4" / "4张"，只匹配ASCII数字
+_COUNT_PREFIX = re.compile(r"[xX×]([0-9]+)|([0-9]+)张")
+_COUNT_NUMBER = re.compile(r"[0-9]+")
+
+# 润色结果按句截断时识别的句末标点
+_SENTENCE_ENDINGS = "。！？!?；;\n"
+
+# 当前请求的人格ID，由生成流水线设置，保存图片时写入图库索引
+_current_persona: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("yoimg_current_persona", default=None)
+
+
+class JobTicket:
+    """调度队列中的一个任务"""
+    
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.started = False
+        self.enqueued_at = time.time()
+        self._future: asyncio.Future = asyncio.get_running_loop().create_future()
+    
+    async def wait(self):
+        """等待轮到本任务执行"""
+        await self._future
+
+
+class JobScheduler:
+    """全局任务调度：限制总并发数，同一用户同时只执行有限个任务，其余按先来后到排队"""
+    
+    def __init__(self, max_concurrency: int = 4, per_user_running: int = 1,
+                 user_max_pending: int = 2, max_queue: int = 50):
+        self.max_concurrency = max(1, max_concurrency)
+        self.per_user_running = max(1, per_user_running)
+        self.user_max_pending = max(1, user_max_pending)
+        self.max_queue = max_queue
+        self.running = 0
+        self.waiting: deque = deque()
+        self.user_running: Dict[str, int] = {}
+        self.user_pending: Dict[str, int] = {}
+    
+    def reject_reason(self, user_id: str) -> Optional[str]:
+        """检查是否可以入队，不能时返回提示语"""
+        if self.user_pending.get(user_id, 0) >= self.user_max_pending:
+            return "🔄 你已有任务在进行中，请稍候..."
+        if self.max_queue > 0 and len(self.waiting) >= self.max_queue:
+            return "🚦 当前排队人数过多，请稍后再试"
+        return None
+    
+    def enqueue(self, user_id: str) -> JobTicket:
+        """任务入队，有空闲名额时立即开始"""
+        ticket = JobTicket(user_id)
+        self.user_pending[user_id] = self.user_pending.get(user_id, 0) + 1
+        self.waiting.append(ticket)
+        self._dispatch()
+        return ticket
+    
+    def position(self, ticket: JobTicket) -> int:
+        """任务在队列中的位置（从1开始），已开始执行返回0"""
+        if ticket.started:
+            return 0
+        try:
+            return self.waiting.index(ticket) + 1
+        except ValueError:
+            return 0
+    
+    def release(self, ticket: JobTicket):
+        """任务结束（或排队中被取消）时释放名额"""
+        if ticket.started:
+            self.running -= 1
+            self._decrement(self.user_running, ticket.user_id)
+        elif ticket in self.waiting:
+            self.waiting.remove(ticket)
+            if not ticket._future.done():
+                ticket._future.cancel()
+        else:
+            return
+        self._decrement(self.user_pending, ticket.user_id)
+        self._dispatch()
+    
+    def clear(self):
+        """取消所有排队任务"""
+        for ticket in self.waiting:
+            if not ticket._future.done():
+                ticket._future.cancel()
+        self.waiting.clear()
+    
+    def _dispatch(self):
+        """按排队顺序启动任务，跳过已达到单用户并发上限的用户"""
+        for ticket in list(self.waiting):
+            if self.running >= self.max_concurrency:
+                break
+            if self.user_running.get(ticket.user_id, 0) >= self.per_user_running:
+                continue
+            self.waiting.remove(ticket)
+            ticket.started = True
+            self.running += 1
+            self.user_running[ticket.user_id] = self.user_running.get(ticket.user_id, 0) + 1
+            if not ticket._future.done():
+                ticket._future.set_result(None)
+    
+    @staticmethod
+    def _decrement(counter: Dict[str, int], user_id: str):
+        remaining = counter.get(user_id, 0) - 1
+        if remaining > 0:
+            counter[user_id] = remaining
+        else:
+            counter.pop(user_id, None)
+
+
+class BackgroundJob:
+    """LLM工具提交的后台生图任务"""
+    
+    STATUS_NAMES = {
+        "queued": "排队中",
+        "running": "生成中",
+        "done": "已完成",
+        "failed": "失败",
+        "cancelled": "已取消"
+    }
+    
+    def __init__(self, job_id: str, user_id: str, origin: str, keyword: str, ticket: JobTicket,
+                 count: int = 1, quota_scopes: Optional[List[tuple]] = None):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.origin = origin
+        self.keyword = keyword
+        self.ticket = ticket
+        self.count = count
+        self.delivered = 0
+        self.status = "queued"
+        self.error = ""
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self.quota_scopes: List[tuple] = quota_scopes or []
+    
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
 
 
 @register("astrbot_plugin_yoimg", "梦千秋", "基于Gitee提供全模型文生图，图生图。", "1.0")
@@ -44,6 +1313,12 @@ class YoYoPlugin(Star):
         # ✅ 从配置schema读取所有配置
         self.base_url = config.get("base_url", "https://ai.gitee.com/v1")
         self.api_keys = config.get("api_key", [])
+        self.key_pool = ApiKeyPool(
+            self.api_keys,
+            strategy=config.get("api_key_strategy", "round_robin"),
+            base_cooldown=config.get("api_key_cooldown", 30),
+            max_inflight_per_key=config.get("per_key_concurrency", 2)
+        )
         
         # 文生图配置
         self.txt2img_endpoint = config.get("txt2img_endpoint", "https://ai.gitee.com/v1/images/generations")
@@ -68,20 +1343,165 @@ class YoYoPlugin(Star):
         self.llm_input_prompt = config.get("llm_input_prompt", "")
         self.persona_extract_prompt = config.get("persona_extract_prompt", "请从以下人设描述中提取关键特征（外貌、性格、背景等），生成一个简洁完整的人格描述，适合用于AI图像生成参考。")
         self.chat_history_count = config.get("chat_history_count", 15)
+        self.chat_history = ChatHistoryExtractor(
+            max_messages=self.chat_history_count,
+            budget=config.get("chat_history_budget", 1200),
+            unit=config.get("chat_history_budget_unit", "char")
+        )
         
         # 共享流量池
         self.debug = config.get("debug_mode", False)
         self.use_shared_pool = config.get("use_shared_pool", False)
         self.shared_pool_url = config.get("shared_pool_url", "http://www.内卷.xyz/v1/")
         
+        # 图片下载配置
+        self.download_timeout = config.get("download_timeout", 60)
+        self.download_max_mb = config.get("download_max_mb", 30)
+        
+        # HTTP连接池配置
+        self.http_pool_limit = config.get("http_pool_limit", 100)
+        self.http_pool_limit_per_host = config.get("http_pool_limit_per_host", 20)
+        self.http_keepalive_timeout = config.get("http_keepalive_timeout", 60)
+        self._http_session: Optional[aiohttp.ClientSession] = None
+        self._http_session_lock = asyncio.Lock()
+        
+        # 上游重试与熔断
+        self.retry_max_attempts = max(1, config.get("retry_max_attempts", 3))
+        self.retry_base_delay = config.get("retry_base_delay", 1.0)
+        self.retry_max_delay = config.get("retry_max_delay", 20)
+        self.breakers: Dict[str, CircuitBreaker] = {
+            name: CircuitBreaker(
+                name,
+                failure_threshold=config.get("breaker_failure_threshold", 5),
+                recovery_timeout=config.get("breaker_recovery_seconds", 60),
+                on_change=self._on_breaker_change
+            ) for name in ("gitee", "shared_pool", "siliconflow", "cdn")
+        }
+        
+        # 生图限额（按用户、按群/会话）
+        self.rate_limit_enabled = config.get("rate_limit_enabled", True)
+        self.quota = QuotaLimiter({
+            "user": {
+                "burst": config.get("user_burst", 3),
+                "per_minute": config.get("user_refill_per_minute", 2),
+                "hourly": config.get("user_hourly_quota", 20),
+                "daily": config.get("user_daily_quota", 100)
+            },
+            "group": {
+                "burst": config.get("group_burst", 6),
+                "per_minute": config.get("group_refill_per_minute", 6),
+                "hourly": config.get("group_hourly_quota", 60),
+                "daily": config.get("group_daily_quota", 300)
+            }
+        }, persist_file=self.data_dir / "quota.json")
+        self._quota_save_handle: Optional[asyncio.TimerHandle] = None
+        
+        # 批量生成
+        self.batch_max_count = config.get("batch_max_count", 4)
+        self.batch_mode = config.get("batch_mode", "auto")
+        
+        # 生图后端路由（直连Gitee / 共享流量池）
+        self.router = BackendRouter(
+            ["gitee", "shared_pool"],
+            error_threshold=config.get("router_error_threshold", 0.5),
+            weights={"shared_pool": 1 / max(0.1, config.get("shared_pool_bias", 1.5))}
+        )
+        
+        # 润色缓存
+        self.polish_cache_enabled = config.get("polish_cache_enabled", True)
+        self.polish_stream = config.get("polish_stream", True)
+        self.polish_max_tokens = config.get("polish_max_tokens", 500)
+        self.polish_max_chars = config.get("polish_max_chars", 0)
+        self.polish_cut_at_sentence = config.get("polish_cut_at_sentence", True)
+        self.polish_cache = TTLCache(
+            max_size=config.get("polish_cache_size", 256),
+            ttl=config.get("polish_cache_ttl", 600),
+            persist_file=self.data_dir / "polish_cache.json" if config.get("polish_cache_persist", False) else None
+        )
+        
+        # 生图结果缓存与图片去重
+        self.result_cache_enabled = config.get("result_cache_enabled", False)
+        self.result_cache = TTLCache(
+            max_size=config.get("result_cache_size", 512),
+            ttl=config.get("result_cache_ttl", 86400),
+            persist_file=self.data_dir / "result_cache.json"
+        )
+        self.image_dedup = config.get("image_dedup", True)
+        
+        # 形象图预处理缓存
+        self.reference_cache = ReferenceImageCache(
+            optimize=config.get("reference_image_optimize", True),
+            jpeg_quality=config.get("reference_image_quality", 90)
+        )
+        
+        # 性能指标
+        self.metrics = MetricsRegistry()
+        self.metrics_flush_interval = config.get("metrics_flush_interval", 10)
+        self._metrics_flush_handle: Optional[asyncio.TimerHandle] = None
+        
+        # 图库索引（放在img目录下，与管理面板共用）
+        try:
+            self._migrate_gallery_db()
+            self.gallery = GalleryIndex(self.img_dir / GALLERY_DB_NAME, self.gitee_img_dir)
+        except Exception as e:
+            logger.error("初始化图库索引失败: %s", str(e))
+            self.gallery = None
+        
+        # LLM工具后台任务
+        self.llm_async_mode = config.get("llm_async_mode", True)
+        self.job_history_size = config.get("job_history_size", 50)
+        self.background_jobs: "OrderedDict[str, BackgroundJob]" = OrderedDict()
+        
+        # 图片/日志清理
+        self.housekeeping_enabled = config.get("housekeeping_enabled", True)
+        self.housekeeping_interval = config.get("housekeeping_interval_minutes", 60) * 60
+        self.image_max_age_days = config.get("image_max_age_days", 0)
+        self.image_max_total_mb = config.get("image_max_total_mb", 0)
+        self.image_max_count = config.get("image_max_count", 0)
+        self.log_compress = config.get("log_compress", True)
+        self.gitee_thumb_dir = self.img_dir / "giteeimg_thumbs"
+        
+        # 启动预热
+        self.startup_warmup = config.get("startup_warmup", True)
+        self.warmup_validate_keys = config.get("warmup_validate_keys", True)
+        self.warmup_urls = config.get("warmup_urls", [])
+        self.startup_report: Dict[str, Any] = {}
+        
+        # 日志写入
+        self.log_max_payload_chars = config.get("log_max_payload_chars", 2000)
+        self.log_writer = AsyncLogWriter(
+            self.log_dir,
+            max_queue=config.get("log_queue_size", 1000),
+            rotate_mode=config.get("log_rotate_mode", "size"),
+            max_bytes=config.get("log_max_mb", 10) * 1024 * 1024,
+            backup_count=config.get("log_backup_count", 5)
+        )
+        
         # 加载人格数据
-        self.personas = self._load_personas()
+        self.persona_store = PersonaStore(self.personas_file)
+        
+        # 任务调度
+        self.scheduler = JobScheduler(
+            max_concurrency=config.get("max_concurrency", 4),
+            user_max_pending=config.get("user_max_pending", 2),
+            max_queue=config.get("queue_max_size", 50)
+        )
         
-        # 处理状态跟踪
-        self.processing = set()
+        # 后台清理任务
+        self._housekeeping_task: Optional[asyncio.Task] = None
+        if self.housekeeping_enabled:
+            try:
+                self._housekeeping_task = asyncio.get_running_loop().create_task(self._housekeeping_loop())
+            except RuntimeError:
+                logger.warning("当前没有运行中的事件循环，后台清理任务未启动")
         
-        # 初始化OpenAI客户端
-        self._init_openai_client()
+        # 启动预热任务
+        self._warmup_task: Optional[asyncio.Task] = None
+        if self.startup_warmup:
+            try:
+                self._warmup_task = asyncio.get_running_loop().create_task(self._run_warmup())
+            except RuntimeError:
+                logger.warning("当前没有运行中的事件循环，启动预热未执行")
         
         logger.info("✅ YOIMG插件初始化完成，数据目录: %s", self.data_dir)
               
@@ -90,55 +1510,65 @@ class YoYoPlugin(Star):
             ['python', 'flask_server.py']
         ), daemon=True).start()
     
-    def _init_openai_client(self):
-        """初始化OpenAI客户端"""
-        if self.api_keys:
-            api_key = self.api_keys[0] if isinstance(self.api_keys, list) else str(self.api_keys)
-            self.openai_client = AsyncOpenAI(
-                base_url=self.base_url,
-                api_key=api_key,
-                timeout=180
-            )
-        else:
-            self.openai_client = None
+    async def _get_http_session(self) -> aiohttp.ClientSession:
+        """获取插件共享的HTTP会话（首次使用时创建）"""
+        if self._http_session is not None and not self._http_session.closed:
+            return self._http_session
+        
+        async with self._http_session_lock:
+            if self._http_session is None or self._http_session.closed:
+                connector = aiohttp.TCPConnector(
+                    limit=self.http_pool_limit,
+                    limit_per_host=self.http_pool_limit_per_host,
+                    ttl_dns_cache=300,
+                    keepalive_timeout=self.http_keepalive_timeout
+                )
+                self._http_session = aiohttp.ClientSession(connector=connector)
+        return self._http_session
     
-    def _load_personas(self) -> List[Dict]:
-        """加载人格数据"""
-        try:
-            if self.personas_file.exists():
-                with open(self.personas_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                return data
-        except Exception as e:
-            logger.error("加载人格数据失败: %s", str(e))
-        return []
+    async def _close_http_session(self):
+        """关闭共享HTTP会话"""
+        if self._http_session is not None and not self._http_session.closed:
+            await self._http_session.close()
+        self._http_session = None
+    
+    def _migrate_gallery_db(self):
+        """旧版本把图库索引放在数据目录根下，移动到img目录"""
+        legacy = self.data_dir / GALLERY_DB_NAME
+        target = self.img_dir / GALLERY_DB_NAME
+        if not legacy.exists() or target.exists():
+            return
+        for suffix in ("", "-wal", "-shm"):
+            source = legacy.with_name(legacy.name + suffix)
+            if source.exists():
+                os.replace(source, target.with_name(target.name + suffix))
     
-    def _save_personas(self):
+    async def _save_personas(self):
         """保存人格数据"""
         try:
-            with open(self.personas_file, 'w', encoding='utf-8') as f:
-                json.dump(self.personas, f, ensure_ascii=False, indent=2)
+            await asyncio.to_thread(self.persona_store.save)
         except Exception as e:
             logger.error("保存人格数据失败: %s", str(e))
     
     def _find_persona(self, persona_id: str) -> Optional[Dict]:
         """查找指定人格"""
-        self.personas = self._load_personas()
-        for persona in self.personas:
-            if persona.get("persona_id") == persona_id:
-                return persona
-        return None
+        return self.persona_store.get(persona_id)
     
     @filter.command("yoimg")
     async def init_persona(self, event: AstrMessageEvent):
         """初始化人格"""
         user_id = event.get_sender_id()
-        if user_id in self.processing:
-            yield event.plain_result("🔄 进行中，请稍候...")
+        reject = self.scheduler.reject_reason(user_id)
+        if reject:
+            yield event.plain_result(reject)
             return
         
-        self.processing.add(user_id)
+        ticket = self.scheduler.enqueue(user_id)
         try:
+            if not ticket.started:
+                yield event.plain_result(self._queue_notice(ticket))
+            await ticket.wait()
+            
             persona_data = await self._get_current_persona_data(event)
             if not persona_data:
                 yield event.plain_result("❌ 无法获取当前人格信息")
@@ -168,22 +1598,101 @@ class YoYoPlugin(Star):
                 "polish_time": time.strftime("%Y/%m/%d %H:%M:%S"),
                 "polished_prompt": polished_prompt
             }
+            persona_entry["polish_template"] = self._compile_polish_template(persona_entry)
             
-            if existing:
-                existing.update(persona_entry)
-            else:
-                self.personas.append(persona_entry)
+            self.persona_store.upsert(persona_entry)
+            await self._save_personas()
             
-            self._save_personas()
-            
-            result_msg = f"✅ 人格初始化完成！\n人格ID: {persona_id}"
+            result_msg = (f"✅ 人格初始化完成！\n人格ID: {persona_id}\n"
+                          f"润色模板: 约 {persona_entry['polish_template']['static_tokens']} tokens")
             yield event.plain_result(result_msg)
             
         except Exception as e:
             logger.error("人格初始化失败: %s", str(e))
             yield event.plain_result(f"❌ 初始化失败: {str(e)}")
         finally:
-            self.processing.discard(user_id)
+            self.scheduler.release(ticket)
+    
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("yokeys")
+    async def key_stats_command(self, event: AstrMessageEvent):
+        """查看API密钥使用统计"""
+        if not self.key_pool:
+            yield event.plain_result("❌ 未配置API密钥")
+            return
+        
+        lines = [f"🔑 API密钥统计（策略: {self.key_pool.strategy}）"]
+        for item in self.key_pool.report():
+            line = (f"{item['key']}: 请求{item['requests']} 成功{item['success']} "
+                    f"失败{item['errors']} 限流{item['rate_limited']} 进行中{item['in_flight']}")
+            if item["invalid"]:
+                line += " 已失效"
+            if item["cooldown_remaining"]:
+                line += f" 冷却{item['cooldown_remaining']}s"
+            lines.append(line)
+        yield event.plain_result("\n".join(lines))
+    
+    @filter.command("yojob")
+    async def job_status_command(self, event: AstrMessageEvent):
+        """查看后台生图任务状态"""
+        job_id = event.message_str.replace("/yojob", "").strip()
+        user_id = event.get_sender_id()
+        
+        if job_id:
+            job = self.background_jobs.get(job_id)
+            if not job:
+                yield event.plain_result(f"未找到任务 {job_id}")
+                return
+            yield event.plain_result(self._describe_job(job))
+            return
+        
+        jobs = [job for job in self.background_jobs.values() if job.user_id == user_id][-5:]
+        if not jobs:
+            yield event.plain_result("你还没有后台生图任务")
+            return
+        yield event.plain_result("\n".join(self._describe_job(job) for job in reversed(jobs)))
+    
+    @filter.command("yocancel")
+    async def job_cancel_command(self, event: AstrMessageEvent):
+        """取消后台生图任务"""
+        job_id = event.message_str.replace("/yocancel", "").strip()
+        if not job_id:
+            yield event.plain_result("请提供任务ID，例如：/yocancel job_1a2b3c4d")
+            return
+        
+        job = self.background_jobs.get(job_id)
+        if not job:
+            yield event.plain_result(f"未找到任务 {job_id}")
+            return
+        if job.user_id != event.get_sender_id() and not event.is_admin():
+            yield event.plain_result("只能取消自己提交的任务")
+            return
+        if job.finished:
+            yield event.plain_result(f"任务 {job_id} 已结束（{BackgroundJob.STATUS_NAMES[job.status]}）")
+            return
+        
+        job.task.cancel()
+        yield event.plain_result(f"✅ 已取消任务 {job_id}")
+    
+    @filter.command("yoquota")
+    async def quota_command(self, event: AstrMessageEvent):
+        """查看自己和当前会话的生图额度"""
+        if not self.rate_limit_enabled:
+            yield event.plain_result("未启用生图限额")
+            return
+        
+        group_id = event.get_group_id()
+        user = self.quota.usage("user", f"user:{event.get_sender_id()}")
+        group = self.quota.usage("group", f"group:{group_id}" if group_id else f"origin:{event.unified_msg_origin}")
+        
+        def fmt(used: int, limit: float) -> str:
+            return f"{used}/{int(limit)}" if limit else f"{used}/不限"
+        
+        yield event.plain_result(
+            f"你：本小时 {fmt(user['hourly'], user['hourly_limit'])}，今天 {fmt(user['daily'], user['daily_limit'])}\n"
+            f"{'本群' if group_id else '本会话'}：本小时 {fmt(group['hourly'], group['hourly_limit'])}，"
+            f"今天 {fmt(group['daily'], group['daily_limit'])}"
+        )
     
     @filter.command("yo")
     async def txt2img_command(self, event: AstrMessageEvent):
@@ -194,11 +1703,13 @@ class YoYoPlugin(Star):
         else:
             keyword = message_str.replace("/yo", "").strip()
         
+        keyword, fresh = self._pop_fresh_flag(keyword)
+        keyword, count = self._pop_count(keyword)
         if not keyword:
             yield event.plain_result("请提供关键词，例如：/yo 樱花树下")
             return
         
-        async for result in self._generate_image(event, keyword, is_txt2img=True):
+        async for result in self._generate_image(event, keyword, is_txt2img=True, fresh=fresh, count=count):
             yield result
     
     @filter.command("yoyo")
@@ -210,11 +1721,13 @@ class YoYoPlugin(Star):
         else:
             keyword = message_str.replace("/yoyo", "").strip()
         
+        keyword, fresh = self._pop_fresh_flag(keyword)
+        keyword, count = self._pop_count(keyword)
         if not keyword:
             yield event.plain_result("请提供关键词，例如：/yoyo 在公园")
             return
         
-        async for result in self._generate_image(event, keyword, is_txt2img=False):
+        async for result in self._generate_image(event, keyword, is_txt2img=False, fresh=fresh, count=count):
             yield result
     
     @filter.command("yozero")
@@ -226,26 +1739,40 @@ class YoYoPlugin(Star):
         else:
             keyword = message_str.replace("/yozero", "").strip()
         
+        keyword, fresh = self._pop_fresh_flag(keyword)
+        keyword, count = self._pop_count(keyword)
         if not keyword:
             yield event.plain_result("请提供关键词，例如：/yozero 樱花树下")
             return
         
         user_id = event.get_sender_id()
-        if user_id in self.processing:
-            yield event.plain_result("🔄 进行中，请稍候...")
+        reject = self.scheduler.reject_reason(user_id)
+        if reject:
+            yield event.plain_result(reject)
             return
         
-        self.processing.add(user_id)
+        reject, quota_scopes = self._acquire_quota(event, count)
+        if reject:
+            yield event.plain_result(reject)
+            return
+        
+        ticket = self.scheduler.enqueue(user_id)
         req_id = f"req_{uuid.uuid4().hex[:13]}"
+        delivered = 0
         
         try:
-            result = await self._call_txt2img_api(req_id, keyword)
+            if not ticket.started:
+                yield event.plain_result(self._queue_notice(ticket))
+            await ticket.wait()
+            
+            _current_persona.set(None)
+            result = await self._timed({}, "generate", self._generate_with_cache(req_id, keyword, fresh=fresh, count=count))
             
             if result["success"]:
-                if self.debug:
-                    yield event.chain_result([Image.fromFileSystem(result["path"]), Plain("✅ 图片生成成功！")])
-                else:
-                    yield event.chain_result([Image.fromFileSystem(result["path"])])
+                delivered = len(result.get("paths") or [result["path"]])
+                send_start = time.perf_counter()
+                yield event.chain_result(self._image_chain(result, count))
+                self._observe_stage("send", (time.perf_counter() - send_start) * 1000)
             else:
                 yield event.plain_result(f"❌ 生成失败: {result['error']}")
                 
@@ -253,497 +1780,680 @@ class YoYoPlugin(Star):
             logger.error("直接文生图失败: %s", str(e))
             yield event.plain_result(f"❌ 生成过程异常: {str(e)}")
         finally:
-            self.processing.discard(user_id)
+            self.scheduler.release(ticket)
+            self._refund_quota(quota_scopes, count - delivered)
     
-    async def _generate_image(self, event: AstrMessageEvent, keyword: str, is_txt2img: bool):
+    async def _generate_image(self, event: AstrMessageEvent, keyword: str, is_txt2img: bool, fresh: bool = False,
+                              count: int = 1):
         """生成图像核心逻辑"""
         user_id = event.get_sender_id()
-        if user_id in self.processing:
-            yield event.plain_result("🔄 进行中，请稍候...")
+        reject = self.scheduler.reject_reason(user_id)
+        if reject:
+            yield event.plain_result(reject)
             return
         
-        self.processing.add(user_id)
-        req_id = f"req_{uuid.uuid4().hex[:13]}"
+        reject, quota_scopes = self._acquire_quota(event, count)
+        if reject:
+            yield event.plain_result(reject)
+            return
+        
+        ticket = self.scheduler.enqueue(user_id)
+        delivered = 0
         
         try:
-            persona_data = await self._get_current_persona_data(event)
-            if not persona_data:
-                yield event.plain_result("❌ 未找到当前人格信息")
-                return
-            
-            persona_id = persona_data["id"]
-            persona_entry = self._find_persona(persona_id)
-            if not persona_entry:
-                yield event.plain_result(f"❌ 人格 '{persona_id}' 未初始化，请先使用 /yoimg 初始化")
-                return
-            
-            polished_prompt = persona_entry.get("polished_prompt", "")
-            if not polished_prompt:
-                yield event.plain_result(f"❌ 人格 '{persona_id}' 没有润色描述")
-                return
+            if not ticket.started:
+                yield event.plain_result(self._queue_notice(ticket))
+            await ticket.wait()
             
-            _, chat_history = await self._get_conversation_data(event)
-            
-            if self.use_polish and self.sf_key:
-                final_prompt = await self._call_polish_api(
-                    system_prompt=self.llm_input_prompt,
-                    user_content=f"人格描述：{polished_prompt}\n聊天记录：{chat_history}\n关键词：{keyword}",
-                    api_type=f"{'txt2img' if is_txt2img else 'img2img'}_polish"
-                )
-                
-                if not final_prompt:
-                    yield event.plain_result("❌ 润色失败")
-                    return
-            else:
-                final_prompt = f"{polished_prompt}，{keyword}"
-            
-            # 校验final_prompt不为空
-            if not final_prompt.strip():
-                yield event.plain_result("❌ 生成提示词为空，无法调用API")
-                return
-
-            if is_txt2img:
-                result = await self._call_txt2img_api(req_id, final_prompt)
-            else:
-                png_path = persona_entry.get("png_path", "").strip()
-                if not png_path:
-                    yield event.plain_result("❌ 人格未上传形象图，请通过管理面板上传")
-                    return
-                
-                image_path = Path(png_path)
-                if not image_path.is_absolute():
-                    image_path = self.data_dir / png_path
-                
-                if not image_path.exists():
-                    error_msg = f"❌ 文件不存在！\n路径: {image_path}"
-                    self._log_error_only(error_msg)
-                    yield event.plain_result(error_msg)
-                    return
-                
-                result = await self._call_img2img_api(req_id, final_prompt, image_path)
+            result = await self._run_generation_pipeline(
+                event, keyword, is_txt2img, fresh=fresh, count=count,
+                polish_api_type=f"{'txt2img' if is_txt2img else 'img2img'}_polish"
+            )
             
             if result["success"]:
-                if self.debug:
-                    yield event.chain_result([Image.fromFileSystem(result["path"]), Plain("✅ 图片生成成功！")])
-                else:
-                    yield event.chain_result([Image.fromFileSystem(result["path"])])
+                delivered = len(result.get("paths") or [result["path"]])
+                send_start = time.perf_counter()
+                yield event.chain_result(self._image_chain(result, count))
+                self._observe_stage("send", (time.perf_counter() - send_start) * 1000)
             else:
-                yield event.plain_result(f"❌ 生成失败: {result['error']}")
+                yield event.plain_result(f"❌ {result['error']}")
                 
         except Exception as e:
             logger.error("图像生成失败: %s", str(e))
             yield event.plain_result(f"❌ 生成过程异常: {str(e)}")
         finally:
-            self.processing.discard(user_id)
+            self.scheduler.release(ticket)
+            self._refund_quota(quota_scopes, count - delivered)
     
-    async def _call_txt2img_api(self, req_id: str, prompt: str) -> Dict[str, Any]:
-        """调用文生图API"""
-        if self.use_shared_pool and self.shared_pool_url:
-            return await self._call_shared_pool_txt2img(req_id, prompt)
+    async def _run_generation_pipeline(self, event: AstrMessageEvent, keyword: str, is_txt2img: bool,
+                                       fresh: bool = False, polish_api_type: str = "polish",
+                                       count: int = 1) -> Dict[str, Any]:
+        """生成流水线：获取会话上下文 → 润色与形象图读取并行 → 调用生图接口，记录各阶段耗时"""
+        req_id = f"req_{uuid.uuid4().hex[:13]}"
+        timings: Dict[str, float] = {}
+        pipeline_start = time.perf_counter()
+        _current_persona.set(None)
         
-        if not self.openai_client:
-            return self._error_result("未配置API密钥")
+        stage_start = time.perf_counter()
+        request_ctx = await self._get_request_context(event)
+        if not request_ctx:
+            return self._error_result("未找到当前人格信息")
         
-        try:
-            self._log_to_gitee(req_id, "txt2img", "request", {
-                "method": "openai_sdk",
-                "model": self.txt2img_model,
-                "prompt": prompt,
-                "size": self.size
-            })
-            
-            response = await self.openai_client.images.generate(
-                prompt=prompt,
-                model=self.txt2img_model,
-                size=self.size,
-                n=1,
-                response_format="url"
+        persona_id = request_ctx["persona_id"]
+        _current_persona.set(persona_id)
+        persona_entry = self._find_persona(persona_id)
+        timings["persona"] = round((time.perf_counter() - stage_start) * 1000, 1)
+        self._observe_stage("persona", timings["persona"])
+        if not persona_entry:
+            return self._error_result(f"人格 '{persona_id}' 未初始化，请先使用 /yoimg 初始化")
+        
+        polished_prompt = persona_entry.get("polished_prompt", "")
+        if not polished_prompt:
+            return self._error_result(f"人格 '{persona_id}' 没有润色描述")
+        
+        if not is_txt2img and not persona_entry.get("png_path", "").strip():
+            return self._error_result("人格未上传形象图，请通过管理面板上传")
+        
+        chat_history = await self._timed(timings, "chat", asyncio.to_thread(
+            self._extract_chat_history, request_ctx["history"], request_ctx["conversation_id"]
+        ))
+        
+        polish_step = self._timed(timings, "polish", self._build_final_prompt(
+            persona_entry, chat_history, keyword, polish_api_type, fresh
+        ))
+        reference = None
+        if is_txt2img:
+            final_prompt = await polish_step
+        else:
+            final_prompt, reference = await asyncio.gather(
+                polish_step,
+                self._timed(timings, "reference", self._prepare_reference_image(persona_entry))
             )
-            
-            if not response.data:
-                return self._error_result("未返回图片数据")
-            
-            image_data = response.data[0]
-            if image_data.url:
-                save_path = await self._download_image(image_data.url)
-            elif hasattr(image_data, 'b64_json') and image_data.b64_json:
-                image_bytes = base64.b64decode(image_data.b64_json)
-                filename = f"{int(time.time())}_{uuid.uuid4().hex[:8]}.png"
-                save_path = self.gitee_img_dir / filename
-                with open(save_path, 'wb') as f:
-                    f.write(image_bytes)
+        
+        if final_prompt is None:
+            return self._error_result("润色失败")
+        if not final_prompt.strip():
+            return self._error_result("生成提示词为空，无法调用API")
+        if reference is not None and not reference["success"]:
+            return reference
+        
+        result = await self._timed(timings, "generate", self._generate_with_cache(req_id, final_prompt, reference, fresh, count))
+        
+        timings["total"] = round((time.perf_counter() - pipeline_start) * 1000, 1)
+        self._observe_stage("total", timings["total"])
+        self._log_to_gitee(req_id, "pipeline", "timing", {
+            "persona_id": persona_id,
+            "mode": "txt2img" if is_txt2img else "img2img",
+            "success": result["success"],
+            "backend": result.get("backend", "cache" if result.get("cached") else None),
+            "timings_ms": timings
+        })
+        
+        if not result["success"]:
+            return self._error_result(f"生成失败: {result['error']}")
+        result["persona_id"] = persona_id
+        result["timings"] = timings
+        return result
+    
+    async def _build_final_prompt(self, persona_entry: Dict, chat_history: str, keyword: str,
+                                  api_type: str, fresh: bool = False) -> Optional[str]:
+        """生成最终提示词，润色失败返回None"""
+        if self.use_polish and self.sf_key:
+            template = await self._persona_polish_template(persona_entry)
+            user_content = f"聊天记录：{chat_history}\n关键词：{keyword}"
+            return await self._call_polish_api(
+                system_prompt=template["system"],
+                user_content=user_content,
+                api_type=api_type,
+                use_cache=not fresh,
+                char_budget=self.polish_max_chars,
+                prompt_tokens={
+                    "static": template["static_tokens"],
+                    "dynamic": estimate_tokens(user_content)
+                }
+            )
+        return f"{persona_entry['polished_prompt']}，{keyword}"
+    
+    def _compile_polish_template(self, persona_entry: Dict) -> Dict[str, Any]:
+        """编译人格的润色模板：润色指令和人格描述合成固定的system消息，每次请求逐字节不变，
+        便于上游按前缀命中缓存；聊天记录和关键词只放在后面的user消息里"""
+        system = self._polish_system_prompt(persona_entry)
+        return {"system": system, "static_tokens": estimate_tokens(system)}
+    
+    def _polish_system_prompt(self, persona_entry: Dict) -> str:
+        return f"{self.llm_input_prompt}\n\n人格描述：{persona_entry['polished_prompt']}"
+    
+    async def _persona_polish_template(self, persona_entry: Dict) -> Dict[str, Any]:
+        """取人格已编译的润色模板；旧数据没有模板，或润色指令、人格描述被修改过时重新编译并保存"""
+        template = persona_entry.get("polish_template")
+        if template and template.get("system") == self._polish_system_prompt(persona_entry):
+            return template
+        
+        template = self._compile_polish_template(persona_entry)
+        persona_entry["polish_template"] = template
+        await self._save_personas()
+        logger.info("人格 %s 的润色模板已重新编译（约 %d tokens）",
+                    persona_entry.get("persona_id"), template["static_tokens"])
+        return template
+    
+    async def _generate_with_cache(self, req_id: str, prompt: str, reference: Optional[Dict[str, Any]] = None,
+                                   fresh: bool = False, count: int = 1) -> Dict[str, Any]:
+        """调用生图接口（reference为空时文生图），开启结果缓存时相同请求参数直接复用已生成的图片"""
+        if count > 1:
+            # 批量生成本身就是要多张不同的图，不走结果缓存
+            return await self._generate_batch(req_id, prompt, reference, count)
+        
+        cache_key = None
+        if self.result_cache_enabled:
+            if reference is None:
+                cache_key = self.result_cache.make_key(
+                    "txt2img", self.txt2img_model, prompt, self.size, str(self.num_inference_steps)
+                )
             else:
-                return self._error_result("未返回有效的图片数据")
-            
-            self._log_to_gitee(req_id, "txt2img", "response", {
-                "status": "success",
-                "save_path": str(save_path)
-            })
-            
-            return {
-                "success": True,
-                "path": str(save_path)
-            }
-            
-        except Exception as e:
-            error_info = str(e)
-            self._log_to_gitee(req_id, "txt2img", "response", {
-                "status": "error",
-                "error": error_info
-            })
-            
-            return await self._call_txt2img_native(req_id, prompt)
+                cache_key = self.result_cache.make_key(
+                    "img2img", self.img2img_model, prompt, self.size, str(self.num_inference_steps),
+                    str(self.cfg_scale), reference["sha256"]
+                )
+            cached = None if fresh else self.result_cache.get(cache_key)
+            if cached and (self.gitee_img_dir / cached).exists():
+                self._log_to_gitee(req_id, "result_cache", "cache_hit", {
+                    "filename": cached,
+                    "cache": self.result_cache.stats()
+                })
+                return {"success": True, "path": str(self.gitee_img_dir / cached), "cached": True}
+        
+        if reference is None:
+            result = await self._call_txt2img_api(req_id, prompt)
+        else:
+            result = await self._call_img2img_api(req_id, prompt, reference)
+        
+        if cache_key and result["success"]:
+            self.result_cache.set(cache_key, Path(result["path"]).name)
+        return result
     
-    async def _call_txt2img_native(self, req_id: str, prompt: str) -> Dict[str, Any]:
-        """原生文生图API调用"""
-        if self.use_shared_pool and self.shared_pool_url:
-            return await self._call_shared_pool_txt2img(req_id, prompt)
+    async def _generate_batch(self, req_id: str, prompt: str, reference: Optional[Dict[str, Any]],
+                              count: int) -> Dict[str, Any]:
+        """批量生成：先用一次带n的请求，返回数量不足（模型不支持n）时并发补齐；batch_mode为fanout时直接并发"""
+        def call(sub_req_id: str, n: int):
+            if reference is None:
+                return self._call_txt2img_api(sub_req_id, prompt, n)
+            return self._call_img2img_api(sub_req_id, prompt, reference, n)
         
-        if not self.api_keys:
-            return self._error_result("未配置API密钥")
+        paths: List[str] = []
+        errors: List[str] = []
+        if self.batch_mode != "fanout":
+            result = await call(req_id, count)
+            if result["success"]:
+                paths.extend(result["paths"])
+            else:
+                errors.append(result["error"])
+                # 上游限流/熔断时不再并发补齐，避免放大压力
+                if result.get("failover"):
+                    return result
         
-        api_key = self.api_keys[0] if isinstance(self.api_keys, list) else str(self.api_keys)
+        missing = count - len(paths)
+        if missing > 0:
+            results = await asyncio.gather(*(call(f"{req_id}_{i + 1}", 1) for i in range(missing)))
+            for result in results:
+                if result["success"]:
+                    paths.extend(result["paths"])
+                else:
+                    errors.append(result["error"])
+        
+        paths = list(dict.fromkeys(paths))
+        self._log_to_gitee(req_id, "batch", "summary", {
+            "requested": count,
+            "received": len(paths),
+            "mode": self.batch_mode,
+            "errors": errors
+        })
+        if not paths:
+            return self._error_result(errors[-1] if errors else "未返回图片")
+        return {"success": True, "path": paths[0], "paths": paths}
+    
+    async def _prepare_reference_image(self, persona_entry: Dict) -> Dict[str, Any]:
+        """取得人格形象图（按生图尺寸预处理并缓存），供图生图上传"""
+        png_path = persona_entry.get("png_path", "").strip()
+        image_path = Path(png_path)
+        if not image_path.is_absolute():
+            image_path = self.data_dir / png_path
         
         try:
-            request_body = {
-                "prompt": prompt,
-                "model": self.txt2img_model,
-                "size": self.size,
-                "n": 1,
-                "response_format": "url",
-                "num_inference_steps": self.num_inference_steps
-            }
-            
-            self._log_to_gitee(req_id, "txt2img_native", "request", {
-                "endpoint": self.txt2img_endpoint,
-                "body": request_body
-            })
-            
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    self.txt2img_endpoint,
-                    json=request_body,
-                    headers=headers,
-                    timeout=180
-                ) as resp:
-                    resp_text = await resp.text()
-                    
-                    self._log_to_gitee(req_id, "txt2img_native", "response", {
-                        "status_code": resp.status,
-                        "response": resp_text
-                    })
-                    
-                    if resp.status != 200:
-                        return self._error_result(f"HTTP {resp.status}: {resp_text[:200]}")
-                    
-                    result = json.loads(resp_text)
-                    
-                    if "data" not in result or not result["data"]:
-                        return self._error_result("返回数据格式错误")
-                    
-                    image_info = result["data"][0]
-                    if "url" not in image_info:
-                        return self._error_result("未返回图片URL")
-                    
-                    img_url = image_info["url"]
-                    save_path = await self._download_image(img_url)
-                    
-                    return {
-                        "success": True,
-                        "path": str(save_path)
-                    }
-                    
-        except Exception as e:
-            error_info = str(e)
-            self._log_to_gitee(req_id, "txt2img_native", "response", {
-                "status": "error",
-                "error": error_info
-            })
-            return self._error_result(f"原生文生图失败: {error_info}")
+            reference = await asyncio.to_thread(self.reference_cache.get, image_path, self.size)
+        except FileNotFoundError:
+            error_msg = f"文件不存在！\n路径: {image_path}"
+            self._log_error_only(error_msg)
+            return self._error_result(error_msg)
+        
+        return {"success": True, **reference}
+    
+    async def _timed(self, timings: Dict[str, float], stage: str, coro):
+        """执行协程并记录耗时（毫秒），同时计入性能指标"""
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            timings[stage] = round((time.perf_counter() - start) * 1000, 1)
+            self._observe_stage(stage, timings[stage])
+    
+    def _observe_stage(self, stage: str, duration_ms: float):
+        """记录阶段耗时并安排指标落盘"""
+        self.metrics.observe(stage, duration_ms)
+        self._schedule_metrics_flush()
+    
+    def _schedule_metrics_flush(self):
+        """合并短时间内的多次更新，延迟写出指标文件"""
+        if self._metrics_flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._metrics_flush_handle = loop.call_later(
+            self.metrics_flush_interval,
+            lambda: loop.create_task(self._flush_metrics())
+        )
+    
+    async def _flush_metrics(self):
+        """将指标写入日志目录下的metrics.json和metrics.prom，供管理面板读取"""
+        self._metrics_flush_handle = None
+        gauges = {
+            "queue_waiting": len(self.scheduler.waiting),
+            "jobs_running": self.scheduler.running,
+            "background_jobs": sum(1 for job in self.background_jobs.values() if not job.finished)
+        }
+        snapshot = self.metrics.snapshot(gauges)
+        snapshot["breakers"] = {name: breaker.snapshot() for name, breaker in self.breakers.items()}
+        snapshot["backends"] = self.router.snapshot()
+        prometheus_text = self.metrics.to_prometheus(gauges)
+        prometheus_text += "# TYPE yoimg_breaker_state gauge\n" + "".join(
+            f'yoimg_breaker_state{{upstream="{name}"}} {CircuitBreaker.STATES[breaker.state]}\n'
+            for name, breaker in self.breakers.items()
+        )
+        try:
+            await asyncio.to_thread(self._write_metrics_files, snapshot, prometheus_text)
+        except Exception as e:
+            logger.error("写入性能指标失败: %s", str(e))
+    
+    def _write_metrics_files(self, snapshot: Dict[str, Any], prometheus_text: str):
+        for filename, content in (
+            ("metrics.json", json.dumps(snapshot, ensure_ascii=False, indent=2)),
+            ("metrics.prom", prometheus_text)
+        ):
+            target = self.log_dir / filename
+            tmp_file = target.with_name(filename + ".tmp")
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(tmp_file, target)
+    
+    async def _call_txt2img_api(self, req_id: str, prompt: str, count: int = 1) -> Dict[str, Any]:
+        """调用文生图API，由路由在直连Gitee与共享流量池之间选择"""
+        return await self._route_generation(req_id, {
+            "gitee": lambda: self._call_gitee_txt2img(req_id, prompt, count),
+            "shared_pool": lambda: self._call_shared_pool_txt2img(req_id, prompt, count)
+        })
+    
+    async def _call_gitee_txt2img(self, req_id: str, prompt: str, count: int = 1) -> Dict[str, Any]:
+        """直连Gitee文生图"""
+        if not self.key_pool:
+            return self._error_result("未配置API密钥")
+        
+        request_body = {
+            "prompt": prompt,
+            "model": self.txt2img_model,
+            "size": self.size,
+            "n": count,
+            "response_format": "url",
+            "num_inference_steps": self.num_inference_steps
+        }
+        return await self._request_image(
+            req_id, "txt2img", "gitee", self.txt2img_endpoint,
+            build_request=lambda: {"json": request_body},
+            log_body=request_body, mode="txt2img", error_prefix="文生图失败"
+        )
     
-    async def _call_shared_pool_txt2img(self, req_id: str, prompt: str) -> Dict[str, Any]:
+    async def _call_shared_pool_txt2img(self, req_id: str, prompt: str, count: int = 1) -> Dict[str, Any]:
         """调用共享流量池文生图API"""
         if not self.shared_pool_url:
             return self._error_result("共享流量池URL未配置")
         if not prompt.strip():
             return self._error_result("文生图提示词为空，无法发送请求")
         
-        try:
-            request_body = {
-                "prompt": prompt.strip(),
-                "model": self.txt2img_model or "z-image-turbo",
-                "size": self.size or "1024x1024",
-                "n": 1,
-                "response_format": "url",
-                "num_inference_steps": self.num_inference_steps
-            }
-
-            request_body = {k: v for k, v in request_body.items() if v}
-            
-            self._log_to_gitee(req_id, "shared_pool_txt2img", "request", {
-                "endpoint": self.shared_pool_url,
-                "body": request_body
-            })
-            
-            headers = {
-                "Content-Type": "application/json"
-            }
-            
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    self.shared_pool_url,
-                    json=request_body,
-                    headers=headers,
-                    timeout=180
-                ) as resp:
-                    
-                    resp_text = await resp.text()
-                    
-                    self._log_to_gitee(req_id, "shared_pool_txt2img", "response", {
-                        "status_code": resp.status,
-                        "response": resp_text
-                    })
-                    
-                    if resp.status != 200:
-                        return self._error_result(f"共享流量池HTTP {resp.status}: {resp_text[:200]}")
-                    
-                    try:
-                        result = json.loads(resp_text)
-                    except json.JSONDecodeError:
-                        return self._error_result(f"共享流量池返回非JSON数据: {resp_text[:200]}")
-                    
-                    if "data" not in result or not result["data"]:
-                        return self._error_result("共享流量池返回数据格式错误，缺少data字段")
-                    
-                    image_info = result["data"][0]
-                    if "url" not in image_info:
-                        return self._error_result("共享流量池未返回图片URL")
-                    
-                    img_url = image_info["url"]
-                    save_path = await self._download_image(img_url)
-                    
-                    return {
-                        "success": True,
-                        "path": str(save_path)
-                    }
-                    
-        except Exception as e:
-            error_info = str(e)
-            self._log_to_gitee(req_id, "shared_pool_txt2img", "response", {
-                "status": "error",
-                "error": error_info
-            })
-            return self._error_result(f"共享流量池文生图失败: {error_info}")
-    
-    async def _call_img2img_api(self, req_id: str, prompt: str, image_path: Path) -> Dict[str, Any]:
-        """调用图生图API"""
-        if self.use_shared_pool and self.shared_pool_url:
-            return await self._call_shared_pool_img2img(req_id, prompt, image_path)
+        request_body = {
+            "prompt": prompt.strip(),
+            "model": self.txt2img_model or "z-image-turbo",
+            "size": self.size or "1024x1024",
+            "n": count,
+            "response_format": "url",
+            "num_inference_steps": self.num_inference_steps
+        }
+        request_body = {k: v for k, v in request_body.items() if v}
         
-        if not self.api_keys:
+        return await self._request_image(
+            req_id, "shared_pool_txt2img", "shared_pool", self.shared_pool_url,
+            build_request=lambda: {"json": request_body},
+            log_body=request_body, mode="txt2img", error_prefix="共享流量池文生图失败"
+        )
+    
+    async def _call_img2img_api(self, req_id: str, prompt: str, reference: Dict[str, Any],
+                                count: int = 1) -> Dict[str, Any]:
+        """调用图生图API，reference为_prepare_reference_image准备好的形象图"""
+        return await self._route_generation(req_id, {
+            "gitee": lambda: self._call_gitee_img2img(req_id, prompt, reference, count),
+            "shared_pool": lambda: self._call_shared_pool_img2img(req_id, prompt, reference, count)
+        })
+    
+    async def _call_gitee_img2img(self, req_id: str, prompt: str, reference: Dict[str, Any],
+                                  count: int = 1) -> Dict[str, Any]:
+        """直连Gitee图生图"""
+        if not self.key_pool:
             return self._error_result("未配置API密钥")
         
-        api_key = self.api_keys[0] if isinstance(self.api_keys, list) else str(self.api_keys)
-        
-        try:
-            data = aiohttp.FormData()
-            data.add_field('model', self.img2img_model)
-            data.add_field('prompt', prompt)
-            data.add_field('n', '1')
-            data.add_field('size', self.size)
-            data.add_field('response_format', 'url')
-            data.add_field('num_inference_steps', str(self.num_inference_steps))
-            data.add_field('cfg_scale', str(self.cfg_scale))
-            
-            ext = image_path.suffix.lower()
-            content_type_map = {
-                '.jpg': 'image/jpeg',
-                '.jpeg': 'image/jpeg',
-                '.png': 'image/png',
-                '.gif': 'image/gif',
-                '.webp': 'image/webp'
-            }
-            content_type = content_type_map.get(ext, 'application/octet-stream')
-            
-            headers = {"Authorization": f"Bearer {api_key}"}
-            
-            with open(image_path, 'rb') as f:
-                image_data = f.read()
-            
-            self._log_to_gitee(req_id, "img2img", "request", {
-                "endpoint": self.img2img_endpoint,
-                "body": {
-                    "model": self.img2img_model,
-                    "prompt": prompt[:100],
-                    "size": self.size,
-                    "num_inference_steps": self.num_inference_steps,
-                    "cfg_scale": self.cfg_scale,
-                    "image_name": image_path.name,
-                    "image_size": len(image_data)
-                }
-            })
-            
-            async with aiohttp.ClientSession() as session:
-                with open(image_path, 'rb') as f:
-                    data.add_field(
-                        'image',
-                        f,
-                        filename=image_path.name,
-                        content_type=content_type
-                    )
-                    
-                    async with session.post(
-                        self.img2img_endpoint, 
-                        data=data,
-                        headers=headers, 
-                        timeout=180
-                    ) as resp:
-                        
-                        resp_text = await resp.text()
-                        
-                        self._log_to_gitee(req_id, "img2img", "response", {
-                            "status_code": resp.status,
-                            "response": resp_text
-                        })
-                        
-                        if resp.status != 200:
-                            return self._error_result(f"HTTP {resp.status}: {resp_text[:200]}")
-                        
-                        result = json.loads(resp_text)
-                        
-                        if "data" not in result or not result["data"]:
-                            return self._error_result("返回数据格式错误")
-                        
-                        image_info = result["data"][0]
-                        if "url" not in image_info:
-                            return self._error_result("未返回图片URL")
-                        
-                        img_url = image_info["url"]
-                        save_path = await self._download_image(img_url)
-                        
-                        return {
-                            "success": True,
-                            "path": str(save_path)
-                        }
-                        
-        except Exception as e:
-            error_info = str(e)
-            self._log_to_gitee(req_id, "img2img", "response", {
-                "status": "error",
-                "error": error_info
-            })
-            return self._error_result(f"图生图失败: {error_info}")
+        return await self._request_image(
+            req_id, "img2img", "gitee", self.img2img_endpoint,
+            build_request=lambda: {"data": self._img2img_form(self.img2img_model, prompt, reference, count)},
+            log_body=self._img2img_log_body(prompt, reference), mode="img2img", error_prefix="图生图失败"
+        )
     
-    async def _call_shared_pool_img2img(self, req_id: str, prompt: str, image_path: Path) -> Dict[str, Any]:
+    async def _call_shared_pool_img2img(self, req_id: str, prompt: str, reference: Dict[str, Any],
+                                        count: int = 1) -> Dict[str, Any]:
         """调用共享流量池图生图API"""
         if not self.shared_pool_url:
             return self._error_result("共享流量池URL未配置")
         if not prompt.strip():
             return self._error_result("图生图提示词为空")
-        if not image_path.exists():
-            return self._error_result(f"原图不存在: {str(image_path)}")
+        if not reference.get("data"):
+            return self._error_result(f"原图不存在: {reference.get('path')}")
+        
+        return await self._request_image(
+            req_id, "shared_pool_img2img", "shared_pool", self.shared_pool_url,
+            build_request=lambda: {"data": self._img2img_form(
+                self.img2img_model or "z-image-turbo", prompt.strip(), reference, count, self.size or "1024x1024"
+            )},
+            log_body=self._img2img_log_body(prompt, reference), mode="img2img", error_prefix="共享流量池图生图失败"
+        )
+    
+    def _available_backends(self) -> List[str]:
+        """已配置的生图后端，优先返回未熔断、有可用密钥（启动校验未判定无效）的；都不可用时返回全部已配置的，由调用给出具体错误"""
+        configured = []
+        if self.key_pool:
+            configured.append("gitee")
+        if self.use_shared_pool and self.shared_pool_url:
+            configured.append("shared_pool")
+        
+        healthy = [
+            name for name in configured
+            if self.breakers[name].is_available() and (
+                name != "gitee" or (self.key_pool.valid_count() > 0 and self.key_pool.available_count() > 0)
+            )
+        ]
+        return healthy or configured
+    
+    async def _route_generation(self, req_id: str, calls: Dict[str, Any]) -> Dict[str, Any]:
+        """按路由顺序调用生图后端，上游明确未处理请求（熔断、限流、连接失败）时转移到下一个后端"""
+        candidates = self._available_backends()
+        if not candidates:
+            return self._error_result("未配置API密钥或共享流量池")
+        
+        order = self.router.rank(candidates)
+        self._log_to_gitee(req_id, "router", "route", {
+            "order": order,
+            "backends": self.router.snapshot()
+        })
+        
+        result = None
+        for index, backend in enumerate(order):
+            start = time.perf_counter()
+            success = False
+            self.router.begin(backend)
+            try:
+                result = await calls[backend]()
+                success = result["success"]
+            finally:
+                failover = result is not None and result.get("failover", False) and index + 1 < len(order)
+                self.router.end(backend, success, (time.perf_counter() - start) * 1000, failover)
+            
+            result["backend"] = backend
+            if not failover:
+                break
+            logger.warning("后端 %s 不可用（%s），转移到 %s", backend, result["error"], order[index + 1])
+            self._log_to_gitee(req_id, "router", "failover", {
+                "from": backend,
+                "to": order[index + 1],
+                "error": result["error"]
+            })
+        
+        self._log_to_gitee(req_id, "router", "served", {
+            "backend": result["backend"],
+            "success": result["success"]
+        })
+        return result
+    
+    def _img2img_form(self, model: str, prompt: str, reference: Dict[str, Any], count: int = 1,
+                      size: str = "") -> aiohttp.FormData:
+        """构造图生图表单（FormData只能发送一次，每次重试重新构造）"""
+        data = aiohttp.FormData()
+        data.add_field('model', model)
+        data.add_field('prompt', prompt)
+        data.add_field('n', str(count))
+        data.add_field('size', size or self.size)
+        data.add_field('response_format', 'url')
+        data.add_field('num_inference_steps', str(self.num_inference_steps))
+        data.add_field('cfg_scale', str(self.cfg_scale))
+        data.add_field(
+            'image',
+            reference["data"],
+            filename=reference["name"],
+            content_type=reference["content_type"]
+        )
+        return data
+    
+    def _img2img_log_body(self, prompt: str, reference: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "model": self.img2img_model,
+            "prompt": prompt[:100],
+            "size": self.size,
+            "num_inference_steps": self.num_inference_steps,
+            "cfg_scale": self.cfg_scale,
+            "image_name": reference["name"],
+            "image_size": len(reference["data"]),
+            "original_size": reference["original_size"]
+        }
+    
+    async def _request_image(self, req_id: str, api_type: str, upstream: str, endpoint: str, build_request,
+                             log_body: Dict[str, Any], mode: str, error_prefix: str) -> Dict[str, Any]:
+        """发送生图请求（经重试与熔断），解析返回的图片URL或base64并保存到本地"""
+        self._log_to_gitee(req_id, api_type, "request", {
+            "endpoint": endpoint,
+            "body": log_body
+        })
         
         try:
-            data = aiohttp.FormData()
-            data.add_field('model', self.img2img_model or "z-image-turbo")
-            data.add_field('prompt', prompt.strip())
-            data.add_field('n', '1')
-            data.add_field('size', self.size or "1024x1024")
-            data.add_field('response_format', 'url')
-            data.add_field('num_inference_steps', str(self.num_inference_steps))
-            data.add_field('cfg_scale', str(self.cfg_scale))
+            status, resp_text = await self._upstream_request(
+                upstream, req_id, self._image_sender(upstream, endpoint, build_request)
+            )
             
-            ext = image_path.suffix.lower()
-            content_type_map = {
-                '.jpg': 'image/jpeg',
-                '.jpeg': 'image/jpeg',
-                '.png': 'image/png',
-                '.gif': 'image/gif',
-                '.webp': 'image/webp'
-            }
-            content_type = content_type_map.get(ext, 'application/octet-stream')
+            self._log_to_gitee(req_id, api_type, "response", {
+                "status_code": status,
+                "response": resp_text
+            })
             
-            with open(image_path, 'rb') as f:
-                image_data = f.read()
+            if status != 200:
+                result = self._error_result(f"{error_prefix}: HTTP {status}: {resp_text[:200]}")
+                # 鉴权失败、限流、过载时上游未处理请求，可以转移到其他后端
+                result["failover"] = status in (401, 403, 429, 503)
+                return result
             
-            self._log_to_gitee(req_id, "shared_pool_img2img", "request", {
-                "endpoint": self.shared_pool_url,
-                "body": {
-                    "model": self.img2img_model,
-                    "prompt": prompt[:100],
-                    "size": self.size,
-                    "num_inference_steps": self.num_inference_steps,
-                    "cfg_scale": self.cfg_scale,
-                    "image_name": image_path.name,
-                    "image_size": len(image_data)
-                }
-            })
+            try:
+                result = json.loads(resp_text)
+            except json.JSONDecodeError:
+                return self._error_result(f"{error_prefix}: 返回非JSON数据: {resp_text[:200]}")
+            
+            if not result.get("data"):
+                return self._error_result(f"{error_prefix}: 返回数据格式错误，缺少data字段")
+            
+            # 多张图片并行下载
+            saved = await asyncio.gather(
+                *(self._save_image_item(item, req_id, mode) for item in result["data"]),
+                return_exceptions=True
+            )
+            paths = list(dict.fromkeys(str(p) for p in saved if isinstance(p, Path)))
+            if not paths:
+                return self._error_result(f"{error_prefix}: {saved[0]}")
+            
+            return {
+                "success": True,
+                "path": paths[0],
+                "paths": paths
+            }
             
-            async with aiohttp.ClientSession() as session:
-                with open(image_path, 'rb') as f:
-                    data.add_field(
-                        'image',
-                        f,
-                        filename=image_path.name,
-                        content_type=content_type
-                    )
-                    
-                    async with session.post(
-                        self.shared_pool_url, 
-                        data=data,
-                        timeout=180
-                    ) as resp:
-                        
-                        resp_text = await resp.text()
-                        
-                        self._log_to_gitee(req_id, "shared_pool_img2img", "response", {
-                            "status_code": resp.status,
-                            "response": resp_text
-                        })
-                        
-                        if resp.status != 200:
-                            return self._error_result(f"共享流量池HTTP {resp.status}: {resp_text[:200]}")
-                        
-                        try:
-                            result = json.loads(resp_text)
-                        except json.JSONDecodeError:
-                            return self._error_result(f"共享流量池返回非JSON数据: {resp_text[:200]}")
-                        
-                        if "data" not in result or not result["data"]:
-                            return self._error_result("共享流量池返回数据格式错误，缺少data字段")
-                        
-                        image_info = result["data"][0]
-                        if "url" not in image_info:
-                            return self._error_result("共享流量池未返回图片URL")
-                        
-                        img_url = image_info["url"]
-                        save_path = await self._download_image(img_url)
-                        
-                        return {
-                            "success": True,
-                            "path": str(save_path)
-                        }
-                        
         except Exception as e:
             error_info = str(e)
-            self._log_to_gitee(req_id, "shared_pool_img2img", "response", {
+            self._log_to_gitee(req_id, api_type, "response", {
                 "status": "error",
                 "error": error_info
             })
-            return self._error_result(f"共享流量池图生图失败: {error_info}")
+            result = self._error_result(f"{error_prefix}: {error_info}")
+            result["failover"] = isinstance(e, (CircuitOpenError, KeyCooldownError, aiohttp.ClientConnectorError))
+            return result
+    
+    async def _save_image_item(self, image_info: Dict[str, Any], req_id: str, mode: str) -> Path:
+        """保存接口返回的一张图片（URL下载或base64解码）"""
+        if image_info.get("url"):
+            return await self._download_image(image_info["url"], req_id, mode)
+        if image_info.get("b64_json"):
+            save_path = await asyncio.to_thread(self._save_b64_image, image_info["b64_json"])
+            return await self._record_gallery_image(save_path, req_id, mode)
+        raise Exception("未返回图片URL")
+    
+    def _image_sender(self, upstream: str, endpoint: str, build_request):
+        """生成单次请求函数：直连Gitee时每次尝试重新分配密钥并按结果归还"""
+        async def send() -> tuple:
+            api_key = await self.key_pool.acquire(max_wait=self.retry_max_delay) if upstream == "gitee" else None
+            status_code, error_info = None, ""
+            try:
+                headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+                session = await self._get_http_session()
+                async with session.post(endpoint, headers=headers, timeout=180, **build_request()) as resp:
+                    resp_text = await resp.text()
+                    status_code = resp.status
+                    if resp.status != 200:
+                        error_info = resp_text
+                    return resp.status, resp_text, resp.headers.get("Retry-After")
+            except Exception as e:
+                error_info = str(e)
+                raise
+            finally:
+                if api_key:
+                    self.key_pool.release(api_key, status_code, error_info)
+        return send
+    
+    async def _upstream_request(self, upstream: str, req_id: str, send, idempotent: bool = False) -> tuple:
+        """经熔断器和重试策略调用上游，send每次发起一次请求并返回 (状态码, 内容, Retry-After)
+        
+        非幂等请求（生图）只在确定未被处理时重试：连接失败、429、503；
+        幂等请求（润色、下载）还会在超时、断连和500/502/504时重试。
+        直连Gitee返回401/403时换一个密钥重试，每个密钥最多试一次。
+        """
+        breaker = self.breakers[upstream]
+        attempt = 0
+        key_retries = 0
+        while True:
+            if not breaker.allow():
+                raise CircuitOpenError(f"上游 {upstream} 熔断中，约 {max(1, breaker.retry_in())} 秒后恢复")
+            attempt += 1
+            retry_after = None
+            
+            try:
+                status, payload, retry_after_header = await send()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                breaker.record_failure()
+                retryable = idempotent or isinstance(e, aiohttp.ClientConnectorError)
+                if not retryable or attempt >= self.retry_max_attempts:
+                    raise
+                reason = f"{type(e).__name__}: {e}"
+            except BaseException:
+                breaker.cancel_probe()
+                raise
+            else:
+                if status == 429 or status >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                if (upstream == "gitee" and status in (401, 403) and self.key_pool.valid_count() > 0
+                        and key_retries < len(self.key_pool) - 1):
+                    # 密钥被拒绝（归还时已标记为失效），上游未处理请求，换一个密钥立即重试，不计入重试次数
+                    key_retries += 1
+                    attempt -= 1
+                    self._log_to_gitee(req_id, upstream, "retry", {
+                        "attempt": attempt,
+                        "reason": f"HTTP {status}，更换密钥",
+                        "delay_s": 0
+                    })
+                    continue
+                retryable = status in (429, 503) or (idempotent and status in (500, 502, 504))
+                if not retryable or attempt >= self.retry_max_attempts:
+                    return status, payload
+                retry_after = self._parse_retry_after(retry_after_header)
+                if retry_after is not None and retry_after > self.retry_max_delay:
+                    return status, payload
+                reason = f"HTTP {status}"
+            
+            if retry_after is None:
+                # 指数退避 + 全抖动
+                retry_after = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** (attempt - 1)))
+            self._log_to_gitee(req_id, upstream, "retry", {
+                "attempt": attempt,
+                "reason": reason,
+                "delay_s": round(retry_after, 2)
+            })
+            await asyncio.sleep(retry_after)
+    
+    @staticmethod
+    def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """解析Retry-After头（秒数或HTTP日期）"""
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
     
-    async def _call_polish_api(self, system_prompt: str, user_content: str, api_type: str) -> Optional[str]:
-        """调用润色API"""
+    def _on_breaker_change(self, breaker: CircuitBreaker, old_state: str):
+        """熔断器状态变化时记录日志并尽快刷新面板指标"""
+        logger.warning("上游 %s 熔断器状态变化: %s → %s", breaker.name, old_state, breaker.state)
+        self._log_to_gitee("breaker", breaker.name, "state_change", {
+            "from": old_state,
+            **breaker.snapshot()
+        })
+        self._schedule_metrics_flush()
+    
+    async def _call_polish_api(self, system_prompt: str, user_content: str, api_type: str,
+                               use_cache: bool = False, char_budget: int = 0,
+                               prompt_tokens: Optional[Dict[str, int]] = None) -> Optional[str]:
+        """调用润色API，use_cache为True时相同输入直接复用最近的润色结果；流式返回时累计超过char_budget字即提前结束
+        
+        prompt_tokens为固定前缀/动态部分的估算token数，记录到请求日志中
+        """
         if not self.sf_key:
             return None
         
         req_id = uuid.uuid4().hex[:8]
         
+        cache_key = None
+        if use_cache and self.polish_cache_enabled:
+            cache_key = self.polish_cache.make_key(self.sf_model, system_prompt, user_content)
+            cached = self.polish_cache.get(cache_key)
+            if cached:
+                self._log_to_gitee(req_id, api_type, "cache_hit", {
+                    "cache": self.polish_cache.stats()
+                })
+                return cached
+        
         try:
             request_body = {
                 "model": self.sf_model,
@@ -752,79 +2462,181 @@ class YoYoPlugin(Star):
                     {"role": "user", "content": user_content}
                 ],
                 "temperature": 0.7,
-                "max_tokens": 500
+                "max_tokens": self.polish_max_tokens
             }
+            if self.polish_stream:
+                request_body["stream"] = True
             
-            self._log_to_gitee(req_id, api_type, "request", {
+            request_log = {
                 "endpoint": f"{self.sf_url}/chat/completions",
                 "body": request_body
-            })
+            }
+            if prompt_tokens:
+                request_log["prompt_tokens"] = prompt_tokens
+            self._log_to_gitee(req_id, api_type, "request", request_log)
             
             headers = {
                 "Authorization": f"Bearer {self.sf_key}",
                 "Content-Type": "application/json"
             }
             
-            async with aiohttp.ClientSession() as session:
+            start = time.perf_counter()
+            
+            async def send() -> tuple:
+                session = await self._get_http_session()
                 async with session.post(
                     f"{self.sf_url}/chat/completions",
                     json=request_body,
                     headers=headers,
                     timeout=30
                 ) as resp:
-                    
-                    resp_text = await resp.text()
-                    
-                    self._log_to_gitee(req_id, api_type, "response", {
-                        "status_code": resp.status,
-                        "response": resp_text
-                    })
-                    
-                    if resp.status != 200:
-                        return None
-                    
-                    result = json.loads(resp_text)
-                    if "choices" not in result or len(result["choices"]) == 0:
-                        return None
-                    return result["choices"][0]["message"]["content"].strip()
-            
-            return None
+                    if resp.status != 200 or not self.polish_stream:
+                        return resp.status, await resp.text(), resp.headers.get("Retry-After")
+                    return resp.status, await self._read_polish_stream(resp, start, char_budget), None
+            
+            status, payload = await self._upstream_request("siliconflow", req_id, send, idempotent=True)
+            
+            if status != 200 or not self.polish_stream:
+                self._log_to_gitee(req_id, api_type, "response", {
+                    "status_code": status,
+                    "response": payload,
+                    "total_ms": round((time.perf_counter() - start) * 1000, 1)
+                })
+                
+                if status != 200:
+                    return None
+                
+                result = json.loads(payload)
+                if "choices" not in result or len(result["choices"]) == 0:
+                    return None
+                content = result["choices"][0]["message"]["content"].strip()
+            else:
+                content, ttft_ms, cut_off = payload
+                total_ms = round((time.perf_counter() - start) * 1000, 1)
+                if ttft_ms is not None:
+                    self._observe_stage("polish_ttft", ttft_ms)
+                
+                self._log_to_gitee(req_id, api_type, "response", {
+                    "status_code": status,
+                    "stream": True,
+                    "content": content,
+                    "chars": len(content),
+                    "cut_off": cut_off,
+                    "ttft_ms": ttft_ms,
+                    "total_ms": total_ms
+                })
+            
+            if cache_key and content:
+                self.polish_cache.set(cache_key, content)
+            return content
         except Exception as e:
             logger.error("润色API调用失败: %s", str(e))
             return None
     
+    async def _read_polish_stream(self, resp: aiohttp.ClientResponse, start: float, char_budget: int) -> tuple:
+        """读取SSE流式润色结果，返回 (文本, 首字耗时毫秒, 是否提前截断)"""
+        parts: List[str] = []
+        received = 0
+        ttft_ms = None
+        cut_off = False
+        
+        async for raw_line in resp.content:
+            line = raw_line.decode('utf-8', errors='ignore').strip()
+            if not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == "[DONE]":
+                break
+            try:
+                chunk = json.loads(payload)
+            except json.JSONDecodeError:
+                continue
+            
+            choices = chunk.get("choices") or []
+            delta = (choices[0].get("delta") or {}).get("content") if choices else None
+            if not delta:
+                continue
+            if ttft_ms is None:
+                ttft_ms = round((time.perf_counter() - start) * 1000, 1)
+            parts.append(delta)
+            received += len(delta)
+            
+            # 达到字数预算后不再等待模型输出，直接断开连接
+            if char_budget > 0 and received >= char_budget:
+                cut_off = True
+                break
+        
+        content = "".join(parts).strip()
+        if cut_off:
+            content = self._truncate_polish_text(content, char_budget)
+        return content, ttft_ms, cut_off
+    
+    def _truncate_polish_text(self, text: str, char_budget: int) -> str:
+        """截断到字数预算内，开启按句截断时回退到最后一个完整句子（不足一半预算时保留硬截断）"""
+        text = text[:char_budget]
+        if self.polish_cut_at_sentence:
+            boundary = max(text.rfind(ch) for ch in _SENTENCE_ENDINGS)
+            if boundary >= len(text) // 2:
+                text = text[:boundary + 1]
+        return text.strip()
+    
     def _log_to_gitee(self, req_id: str, api_type: str, call_type: str, data: Dict):
         """记录Gitee日志"""
         try:
-            log_file = self.log_dir / "gitee.log"
             log_entry = {
                 "timestamp": datetime.now().isoformat(),
                 "req_id": req_id,
                 "api_type": api_type,
                 "call_type": call_type,
-                "data": data
+                "data": self._truncate_log_payload(data)
             }
+            self.log_writer.write("gitee.log", log_entry)
             
-            with open(log_file, 'a', encoding='utf-8') as f:
-                f.write(json.dumps(log_entry, ensure_ascii=False) + '\n')
+            if call_type == "response":
+                success = data.get("status_code") == 200 or data.get("status") == "success"
+                self.metrics.count_call(api_type, success)
+                self._schedule_metrics_flush()
         except Exception as e:
             logger.error("记录Gitee日志失败: %s", str(e))
     
     def _log_error_only(self, error_msg: str):
         """记录错误日志"""
         try:
-            log_file = self.log_dir / "error.log"
             log_entry = {
                 "timestamp": datetime.now().isoformat(),
                 "error": error_msg
             }
-            with open(log_file, 'a', encoding='utf-8') as f:
-                f.write(json.dumps(log_entry, ensure_ascii=False) + '\n')
+            self.log_writer.write("error.log", log_entry)
         except Exception as e:
             logger.error("记录错误日志失败: %s", str(e))
     
+    def _truncate_log_payload(self, value: Any) -> Any:
+        """截断日志中过长的字符串，避免完整记录上游响应"""
+        limit = self.log_max_payload_chars
+        if limit <= 0:
+            return value
+        if isinstance(value, str):
+            if len(value) > limit:
+                return f"{value[:limit]}...[已截断，共{len(value)}字符]"
+            return value
+        if isinstance(value, dict):
+            return {k: self._truncate_log_payload(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._truncate_log_payload(v) for v in value]
+        return value
+    
     async def _get_current_persona_data(self, event: AstrMessageEvent) -> Optional[Dict]:
         """获取当前人格数据"""
+        request_ctx = await self._get_request_context(event, with_raw_persona=True)
+        if not request_ctx:
+            return None
+        return {
+            "id": request_ctx["persona_id"],
+            "raw_persona": request_ctx["raw_persona"]
+        }
+    
+    async def _get_request_context(self, event: AstrMessageEvent, with_raw_persona: bool = False) -> Optional[Dict]:
+        """一次查询会话管理器，获取人格ID、原始人设（可选）和原始聊天记录"""
         try:
             umo = event.unified_msg_origin
             conv_mgr = self.context.conversation_manager
@@ -842,82 +2654,208 @@ class YoYoPlugin(Star):
                 persona_id = "default"
             
             raw_persona = "默认人设"
-            if persona_id != "default":
+            if with_raw_persona and persona_id != "default":
                 persona_mgr = self.context.persona_manager
                 persona = await persona_mgr.get_persona(persona_id)
                 if persona and hasattr(persona, 'system_prompt'):
                     raw_persona = persona.system_prompt
             
             return {
-                "id": persona_id,
-                "raw_persona": raw_persona
+                "persona_id": persona_id,
+                "raw_persona": raw_persona,
+                "conversation_id": curr_cid,
+                "history": conversation.history
             }
             
         except Exception as e:
-            logger.error("获取当前人格数据失败: %s", str(e))
+            logger.error("获取会话数据失败: %s", str(e))
             return None
     
-    async def _get_conversation_data(self, event: AstrMessageEvent):
-        """获取对话数据"""
+    def _extract_chat_history(self, history_json: Optional[str], conversation_id: Optional[str] = None) -> str:
+        """提取最近的聊天记录（不超过条数上限和长度预算）"""
+        return self.chat_history.extract(history_json, conversation_id)
+    
+    async def _download_image(self, url: str, req_id: str = "", mode: str = "") -> Path:
+        """流式下载图片到本地（经重试与熔断），完成后登记到图库索引"""
+        download_start = time.perf_counter()
+        status, save_path = await self._upstream_request(
+            "cdn", req_id, lambda: self._download_once(url), idempotent=True
+        )
+        if status != 200:
+            raise Exception(f"下载失败: HTTP {status}")
+        self._observe_stage("download", (time.perf_counter() - download_start) * 1000)
+        return await self._record_gallery_image(save_path, req_id, mode)
+    
+    async def _download_once(self, url: str) -> tuple:
+        """单次下载：分块写入临时文件，完成后原子重命名，返回 (状态码, 保存路径, Retry-After)"""
+        max_bytes = self.download_max_mb * 1024 * 1024
+        save_path = self._new_image_path()
+        tmp_path = save_path.with_name(f".{save_path.name}.part")
+        
+        session = await self._get_http_session()
+        timeout = aiohttp.ClientTimeout(total=self.download_timeout)
+        async with session.get(url, timeout=timeout) as resp:
+            if resp.status != 200:
+                return resp.status, None, resp.headers.get("Retry-After")
+            if resp.content_length and resp.content_length > max_bytes:
+                raise Exception(f"下载失败: 图片大小 {resp.content_length} 字节超过上限")
+            
+            f = await asyncio.to_thread(open, tmp_path, 'wb')
+            try:
+                received = 0
+                buffer = bytearray()
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    received += len(chunk)
+                    if received > max_bytes:
+                        raise Exception(f"下载失败: 图片大小超过 {self.download_max_mb}MB 上限")
+                    buffer.extend(chunk)
+                    if len(buffer) >= 1024 * 1024:
+                        await asyncio.to_thread(f.write, bytes(buffer))
+                        buffer.clear()
+                if buffer:
+                    await asyncio.to_thread(f.write, bytes(buffer))
+                await asyncio.to_thread(f.close)
+                await asyncio.to_thread(os.replace, tmp_path, save_path)
+            except BaseException:
+                f.close()
+                tmp_path.unlink(missing_ok=True)
+                raise
+        return 200, save_path, None
+    
+    async def _record_gallery_image(self, image_path: Path, req_id: str, mode: str) -> Path:
+        """登记新图片到图库索引并按内容去重，返回实际保存的路径；失败不影响生成结果"""
+        if self.gallery is None:
+            return image_path
         try:
-            umo = event.unified_msg_origin
-            conv_mgr = self.context.conversation_manager
-            curr_cid = await conv_mgr.get_curr_conversation_id(umo)
-            
-            if not curr_cid:
-                return "默认人设", ""
-            
-            conversation = await conv_mgr.get_conversation(umo, curr_cid)
-            if not conversation:
-                return "默认人设", ""
-            
-            persona_text = "默认人设"
-            persona_id = conversation.persona_id
-            if persona_id and persona_id != "[%None]":
-                persona_mgr = self.context.persona_manager
-                persona = await persona_mgr.get_persona(persona_id)
-                if persona and hasattr(persona, 'system_prompt'):
-                    persona_text = persona.system_prompt
-            
-            chat_text = ""
-            history_json = conversation.history
-            if history_json:
-                try:
-                    history_data = json.loads(history_json)
-                    if isinstance(history_data, list):
-                        recent_messages = history_data[-self.chat_history_count:]
-                        messages = []
-                        for msg in recent_messages:
-                            role = msg.get("role", "")
-                            content = msg.get("content", "")
-                            if role and content:
-                                if role == "user":
-                                    messages.append(f"A{content}")
-                                elif role == "assistant":
-                                    messages.append(f"B{content}")
-                        chat_text = "".join(messages)
-                except Exception:
-                    chat_text = ""
-            
-            return persona_text, chat_text
-            
+            return await asyncio.to_thread(self._index_image, image_path, _current_persona.get(), mode, req_id)
         except Exception as e:
-            logger.error("获取对话数据失败: %s", str(e))
-            return "默认人设", ""
-    
-    async def _download_image(self, url: str) -> Path:
-        """下载图片到本地"""
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    data = await resp.read()
-                    filename = f"{int(time.time())}_{uuid.uuid4().hex[:8]}.png"
-                    save_path = self.gitee_img_dir / filename
-                    with open(save_path, 'wb') as f:
-                        f.write(data)
-                    return save_path
-                else:
-                    raise Exception(f"下载失败: HTTP {resp.status}")
+            logger.error("登记图库索引失败: %s", str(e))
+            return image_path
+    
+    def _index_image(self, image_path: Path, persona_id: Optional[str], mode: str, req_id: str) -> Path:
+        """计算图片内容哈希，已存在相同图片时删除新文件并返回已有文件（在线程池中执行）"""
+        if not self.image_dedup:
+            self.gallery.add(image_path, persona_id, mode, req_id)
+            return image_path
+        
+        digest = hashlib.sha256()
+        with open(image_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        sha256 = digest.hexdigest()
+        
+        existing = self.gallery.find_by_hash(sha256)
+        if existing and existing != image_path.name and (self.gitee_img_dir / existing).exists():
+            image_path.unlink(missing_ok=True)
+            logger.info("图片 %s 与已有图片 %s 内容相同，已去重", image_path.name, existing)
+            return self.gitee_img_dir / existing
+        
+        self.gallery.add(image_path, persona_id, mode, req_id, sha256)
+        return image_path
+    
+    def _save_b64_image(self, b64_data: str) -> Path:
+        """分段解码base64图片并原子写入（在线程池中执行）"""
+        save_path = self._new_image_path()
+        tmp_path = save_path.with_name(f".{save_path.name}.part")
+        chunk_chars = 4 * 256 * 1024
+        try:
+            with open(tmp_path, 'wb') as f:
+                for start in range(0, len(b64_data), chunk_chars):
+                    f.write(base64.b64decode(b64_data[start:start + chunk_chars]))
+            os.replace(tmp_path, save_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        return save_path
+    
+    def _new_image_path(self) -> Path:
+        """生成新图片的保存路径"""
+        filename = f"{int(time.time())}_{uuid.uuid4().hex[:8]}.png"
+        return self.gitee_img_dir / filename
+    
+    @staticmethod
+    def _pop_fresh_flag(keyword: str) -> tuple:
+        """去掉关键词中的 --fresh 标记，返回 (关键词, 是否跳过缓存)"""
+        words = keyword.split()
+        if "--fresh" not in words:
+            return keyword, False
+        return " ".join(w for w in words if w != "--fresh"), True
+    
+    def _acquire_quota(self, event: AstrMessageEvent, count: int = 1) -> tuple:
+        """扣除生图额度，返回 (超限提示或None, 扣除的范围)；管理员不受限制"""
+        if not self.rate_limit_enabled or event.is_admin():
+            return None, []
+        
+        group_id = event.get_group_id()
+        scopes = [
+            ("user", f"user:{event.get_sender_id()}"),
+            ("group", f"group:{group_id}" if group_id else f"origin:{event.unified_msg_origin}")
+        ]
+        denied = self.quota.acquire(scopes, count)
+        if not denied:
+            self._schedule_quota_save()
+            return None, scopes
+        
+        minutes = max(1, int(denied["retry_after"] // 60) + (1 if denied["retry_after"] % 60 else 0))
+        who = "你" if denied["kind"] == "user" else ("本群" if group_id else "本会话")
+        if denied["period"] == "burst":
+            reason = f"{who}生图太频繁了"
+        else:
+            period = "本小时" if denied["period"] == "hourly" else "今天"
+            reason = f"{who}{period}的生图额度已用完（上限 {int(denied['limit'])} 张）"
+        return f"⏳ {reason}，请 {minutes} 分钟后再试", []
+    
+    def _refund_quota(self, scopes: List[tuple], cost: int):
+        """生成失败或张数不足时退回额度"""
+        if scopes and cost > 0:
+            self.quota.refund(scopes, cost)
+            self._schedule_quota_save()
+    
+    def _schedule_quota_save(self):
+        """合并短时间内的多次扣除，延迟写出限额记录"""
+        if self._quota_save_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._quota_save_handle = loop.call_later(5, lambda: loop.create_task(self._save_quota()))
+    
+    async def _save_quota(self):
+        self._quota_save_handle = None
+        if not self.quota.dirty:
+            return
+        try:
+            await asyncio.to_thread(self.quota.write, self.quota.snapshot())
+        except Exception as e:
+            self.quota.dirty = True
+            logger.error("保存限额记录失败: %s", str(e))
+    
+    def _pop_count(self, keyword: str) -> tuple:
+        """去掉关键词开头的张数，返回 (关键词, 张数)；只识别明确的写法 "x4"、"4张"、"-n 4"，
+        例如 "4张 樱花树下" → ("樱花树下", 4)，"2 girls on a beach" 保持原样"""
+        words = keyword.split(maxsplit=2)
+        if len(words) >= 3 and words[0] == "-n" and _COUNT_NUMBER.fullmatch(words[1]):
+            return words[2], max(1, min(int(words[1]), self.batch_max_count))
+        words = keyword.split(maxsplit=1)
+        match = _COUNT_PREFIX.fullmatch(words[0]) if len(words) == 2 else None
+        if not match:
+            return keyword, 1
+        return words[1], max(1, min(int(match.group(1) or match.group(2)), self.batch_max_count))
+    
+    def _image_chain(self, result: Dict[str, Any], count: int = 1) -> List:
+        """把生成结果组装成一条消息链，张数不足时附上说明"""
+        paths = result.get("paths") or [result["path"]]
+        chain = [Image.fromFileSystem(path) for path in paths]
+        if len(paths) < count:
+            chain.append(Plain(f"⚠️ 请求 {count} 张，成功生成 {len(paths)} 张"))
+        elif self.debug:
+            chain.append(Plain("✅ 图片生成成功！"))
+        return chain
+    
+    def _queue_notice(self, ticket: JobTicket) -> str:
+        """排队提示语"""
+        return f"⏳ 已加入队列，当前排第 {self.scheduler.position(ticket)} 位，请稍候..."
     
     def _error_result(self, error: str) -> Dict[str, Any]:
         """返回错误结果"""
@@ -927,103 +2865,410 @@ class YoYoPlugin(Star):
         }
     
     @filter.llm_tool(name="yoyo_draw")
-    async def yoyo_llm_tool(self, event: AstrMessageEvent, prompt: str):
+    async def yoyo_llm_tool(self, event: AstrMessageEvent, prompt: str, fresh: bool = False, count: int = 1):
         """
         根据描述生成图像，结合当前人格和聊天记录。
         
         Args:
             prompt(string): 图像描述，可包含触发词如"文生图"
+            fresh(boolean): 用户要求换一张/重新生成时为true，跳过润色缓存
+            count(number): 生成图片的张数，用户要求多张时填写，默认1
         """
+        try:
+            count = max(1, min(int(count or 1), self.batch_max_count))
+        except (TypeError, ValueError):
+            count = 1
+        # 确定生成模式
+        is_txt2img = self.llm_default_mode == "txt2img" or any(
+            word in prompt for word in self.txt2img_trigger_words
+        )
+        
+        keyword = prompt
+        for trigger in self.txt2img_trigger_words:
+            keyword = keyword.replace(trigger, "").strip()
+        
+        if not keyword:
+            return "请提供图片描述"
+        
         user_id = event.get_sender_id()
         
-        if user_id in self.processing:
-            return "正在处理中，请稍候..."
+        reject = self.scheduler.reject_reason(user_id)
+        if reject:
+            return reject
+        
+        reject, quota_scopes = self._acquire_quota(event, count)
+        if reject:
+            return reject
         
-        self.processing.add(user_id)
+        ticket = self.scheduler.enqueue(user_id)
         
+        if self.llm_async_mode:
+            job = self._submit_background_job(event, ticket, keyword, is_txt2img, fresh, count, quota_scopes)
+            return (f"已提交后台生图任务 {job.job_id}，预计约 {self._estimate_eta(ticket)} 秒后完成，"
+                    f"图片生成后会自动发送到当前会话，无需等待。"
+                    f"可用 /yojob {job.job_id} 查看进度，/yocancel {job.job_id} 取消。")
+        
+        delivered = 0
         try:
-            # 确定生成模式
-            is_txt2img = self.llm_default_mode == "txt2img" or any(
-                word in prompt for word in self.txt2img_trigger_words
-            )
-            
-            keyword = prompt
-            for trigger in self.txt2img_trigger_words:
-                keyword = keyword.replace(trigger, "").strip()
-            
-            if not keyword:
-                return "请提供图片描述"
-            
-            # 获取人格数据
-            persona_data = await self._get_current_persona_data(event)
-            if not persona_data:
-                return "未找到当前人格信息"
-            
-            persona_id = persona_data["id"]
-            persona_entry = self._find_persona(persona_id)
-            
-            if not persona_entry:
-                return f"人格 '{persona_id}' 未初始化"
-            
-            polished_prompt = persona_entry.get("polished_prompt", "")
-            if not polished_prompt:
-                return f"人格 '{persona_id}' 没有润色描述"
-            
-            # 获取聊天记录
-            _, chat_history = await self._get_conversation_data(event)
-            
-            # 润色处理
-            if self.use_polish and self.sf_key:
-                final_prompt = await self._call_polish_api(
-                    system_prompt=self.llm_input_prompt,
-                    user_content=f"人格描述：{polished_prompt}\n聊天记录：{chat_history}\n关键词：{keyword}",
-                    api_type=f"{'txt2img' if is_txt2img else 'img2img'}_polish_llm"
-                )
-                
-                if not final_prompt:
-                    return "润色失败"
-            else:
-                final_prompt = f"{polished_prompt}，{keyword}"
-            
-            if not final_prompt.strip():
-                return "生成提示词为空，无法调用API"
-
-            # 调用图像生成API
-            req_id = f"req_{uuid.uuid4().hex[:13]}"
+            if not ticket.started:
+                await event.send(event.plain_result(self._queue_notice(ticket)))
+            await ticket.wait()
             
-            if is_txt2img:
-                result = await self._call_txt2img_api(req_id, final_prompt)
-            else:
-                # 图生图需要检查形象图
-                png_path = persona_entry.get("png_path", "").strip()
-                if not png_path:
-                    return "人格未上传形象图"
-                
-                image_path = Path(png_path)
-                if not image_path.is_absolute():
-                    image_path = self.data_dir / png_path
-                
-                if not image_path.exists():
-                    return "形象图文件不存在"
-                
-                result = await self._call_img2img_api(req_id, final_prompt, image_path)
+            result = await self._run_generation_pipeline(
+                event, keyword, is_txt2img, fresh=fresh, count=count,
+                polish_api_type=f"{'txt2img' if is_txt2img else 'img2img'}_polish_llm"
+            )
             
             if result["success"]:
+                delivered = len(result.get("paths") or [result["path"]])
                 # 手动发送图片
-                await event.send(event.chain_result([Image.fromFileSystem(result["path"])]))
+                await self._timed({}, "send", event.send(event.chain_result(self._image_chain(result, count))))
                 # 返回描述性字符串
-                return f"已为 {persona_id} 人格生成图片。Prompt: {keyword}"
+                return f"已为 {result['persona_id']} 人格生成图片。Prompt: {keyword}"
             else:
-                return f"生成失败: {result.get('error', '未知错误')}"
+                return result["error"]
                 
         except Exception as e:
             error_msg = str(e)
             logger.error("LLM工具生成图像失败: %s", error_msg)
             return f"生成过程异常: {error_msg}"
         finally:
-            self.processing.discard(user_id)
+            self.scheduler.release(ticket)
+            self._refund_quota(quota_scopes, count - delivered)
+    
+    def _submit_background_job(self, event: AstrMessageEvent, ticket: JobTicket, keyword: str,
+                               is_txt2img: bool, fresh: bool, count: int = 1,
+                               quota_scopes: Optional[List[tuple]] = None) -> BackgroundJob:
+        """创建后台任务并立即返回，生成完成后由任务自行推送到原会话"""
+        job = BackgroundJob(f"job_{uuid.uuid4().hex[:8]}", ticket.user_id, event.unified_msg_origin, keyword, ticket,
+                            count, quota_scopes)
+        job.task = asyncio.create_task(self._run_background_job(job, event, is_txt2img, fresh, count))
+        job.task.add_done_callback(lambda task: self._finish_background_job(job, task))
+        self.background_jobs[job.job_id] = job
+        
+        # 只保留最近的已结束任务记录
+        finished = [job_id for job_id, item in self.background_jobs.items() if item.finished]
+        for job_id in finished[:max(0, len(self.background_jobs) - self.job_history_size)]:
+            del self.background_jobs[job_id]
+        return job
+    
+    async def _run_background_job(self, job: BackgroundJob, event: AstrMessageEvent, is_txt2img: bool, fresh: bool,
+                                  count: int = 1):
+        """后台执行生成流水线，并把结果推送到提交任务的会话"""
+        try:
+            await job.ticket.wait()
+            job.status = "running"
+            job.started_at = time.time()
+            
+            result = await self._run_generation_pipeline(
+                event, job.keyword, is_txt2img, fresh=fresh, count=count,
+                polish_api_type=f"{'txt2img' if is_txt2img else 'img2img'}_polish_llm"
+            )
+            
+            if result["success"]:
+                job.delivered = len(result.get("paths") or [result["path"]])
+                await self._timed({}, "send", self.context.send_message(
+                    job.origin, MessageChain(chain=self._image_chain(result, count))
+                ))
+                job.status = "done"
+            else:
+                job.status = "failed"
+                job.error = result["error"]
+                await self.context.send_message(
+                    job.origin, MessageChain(chain=[Plain(f"❌ 生图任务 {job.job_id} 失败: {result['error']}")])
+                )
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            raise
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            logger.error("后台生图任务 %s 失败: %s", job.job_id, str(e))
+            try:
+                await self.context.send_message(
+                    job.origin, MessageChain(chain=[Plain(f"❌ 生图任务 {job.job_id} 失败: {str(e)}")])
+                )
+            except Exception as send_error:
+                logger.error("推送后台生图任务 %s 失败消息失败: %s", job.job_id, str(send_error))
+    
+    def _finish_background_job(self, job: BackgroundJob, task: asyncio.Task):
+        """任务结束后释放调度名额、退回未交付的额度
+        
+        放在完成回调里而不是协程的finally中：任务在开始执行前被取消时协程体根本不会运行。
+        """
+        if job.finished_at is not None:
+            return
+        job.finished_at = time.time()
+        if task.cancelled() and not job.finished:
+            job.status = "cancelled"
+        self.scheduler.release(job.ticket)
+        self._refund_quota(job.quota_scopes, job.count - job.delivered)
+    
+    def _estimate_eta(self, ticket: JobTicket) -> int:
+        """按最近生成耗时的中位数和排队位置估算完成时间（秒）"""
+        per_job = self.metrics.percentile("total", 0.5) / 1000 or 60
+        position = self.scheduler.position(ticket)
+        rounds = 1 if position == 0 else (position - 1) // self.scheduler.max_concurrency + 2
+        return int(per_job * rounds)
+    
+    def _describe_job(self, job: BackgroundJob) -> str:
+        """后台任务的状态描述"""
+        line = f"{job.job_id} [{BackgroundJob.STATUS_NAMES[job.status]}] {job.keyword[:20]}"
+        if job.status == "queued":
+            line += f" 排队第{self.scheduler.position(job.ticket)}位，预计{self._estimate_eta(job.ticket)}秒"
+        elif job.status == "running":
+            line += f" 已运行{int(time.time() - job.started_at)}秒"
+        elif job.status == "done":
+            line += f" 耗时{int(job.finished_at - job.created_at)}秒"
+        elif job.status == "failed":
+            line += f" {job.error[:60]}"
+        return line
+    
+    async def _housekeeping_loop(self):
+        """定期清理过期图片和压缩历史日志，也响应管理面板写入的触发文件"""
+        trigger_file = self.log_dir / "housekeeping.request"
+        next_run = time.monotonic() + 60
+        while True:
+            await asyncio.sleep(30)
+            triggered = trigger_file.exists()
+            if not triggered and time.monotonic() < next_run:
+                continue
+            if triggered:
+                trigger_file.unlink(missing_ok=True)
+            next_run = time.monotonic() + self.housekeeping_interval
+            await self._run_housekeeping(reason="manual" if triggered else "scheduled")
+    
+    async def _run_housekeeping(self, reason: str = "manual") -> Dict[str, Any]:
+        """执行一次清理并写出报告"""
+        try:
+            report = await asyncio.to_thread(self._housekeeping_sync)
+        except Exception as e:
+            logger.error("清理任务失败: %s", str(e))
+            return {"success": False, "error": str(e)}
+        
+        report.update({"success": True, "reason": reason, "finished_at": datetime.now().isoformat()})
+        deleted_names = report.pop("deleted_names")
+        if self.gallery is not None and deleted_names:
+            try:
+                await asyncio.to_thread(self.gallery.remove, deleted_names)
+            except Exception as e:
+                logger.error("更新图库索引失败: %s", str(e))
+        
+        try:
+            await asyncio.to_thread(self._write_report, "housekeeping.json", report)
+        except Exception as e:
+            logger.error("写入清理报告失败: %s", str(e))
+        logger.info("清理完成: 删除图片 %s 张，释放 %.2f MB，压缩日志 %s 个",
+                    report["images_deleted"], report["bytes_reclaimed"] / 1024 / 1024, report["logs_compressed"])
+        return report
+    
+    def _housekeeping_sync(self) -> Dict[str, Any]:
+        """按时间、总大小、数量限制删除最旧的图片，并压缩已轮转的日志段（在线程池中执行）"""
+        images = []
+        for entry in os.scandir(self.gitee_img_dir):
+            if entry.is_file() and not entry.name.startswith("."):
+                stat = entry.stat()
+                images.append((stat.st_mtime, entry.name, stat.st_size))
+        images.sort()
+        
+        total_bytes = sum(size for _, _, size in images)
+        max_total = self.image_max_total_mb * 1024 * 1024
+        cutoff = time.time() - self.image_max_age_days * 86400
+        remaining = len(images)
+        deleted_names: List[str] = []
+        reclaimed = 0
+        
+        for mtime, name, size in images:
+            expired = self.image_max_age_days > 0 and mtime < cutoff
+            over_size = self.image_max_total_mb > 0 and total_bytes > max_total
+            over_count = self.image_max_count > 0 and remaining > self.image_max_count
+            if not (expired or over_size or over_count):
+                break
+            (self.gitee_img_dir / name).unlink(missing_ok=True)
+            (self.gitee_thumb_dir / f"{name}.webp").unlink(missing_ok=True)
+            deleted_names.append(name)
+            reclaimed += size
+            total_bytes -= size
+            remaining -= 1
+        
+        logs_compressed = 0
+        if self.log_compress:
+            for log_name in ("gitee.log", "error.log"):
+                for segment in AsyncLogWriter.list_segments(self.log_dir / log_name):
+                    if segment.suffix == ".gz":
+                        continue
+                    stat = segment.stat()
+                    gz_path = segment.with_name(segment.name + ".gz")
+                    with open(segment, 'rb') as src, gzip.open(gz_path, 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+                    # 保留原修改时间，便于按时间顺序淘汰
+                    os.utime(gz_path, (stat.st_atime, stat.st_mtime))
+                    segment.unlink()
+                    reclaimed += stat.st_size - gz_path.stat().st_size
+                    logs_compressed += 1
+        
+        return {
+            "images_deleted": len(deleted_names),
+            "images_remaining": remaining,
+            "images_total_bytes": total_bytes,
+            "logs_compressed": logs_compressed,
+            "bytes_reclaimed": reclaimed,
+            "deleted_names": deleted_names
+        }
+    
+    def _write_report(self, filename: str, report: Dict[str, Any]):
+        """原子写入日志目录下的JSON报告，供管理面板读取"""
+        target = self.log_dir / filename
+        tmp_file = target.with_name(target.name + ".tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, target)
+    
+    async def _run_warmup(self):
+        """启动预热：预先建立到各上游的连接、校验密钥、加载人格索引和形象图缓存，结果写入startup.json"""
+        start = time.perf_counter()
+        report: Dict[str, Any] = {"started_at": datetime.now().isoformat(timespec="seconds")}
+        try:
+            hosts, keys, personas = await asyncio.gather(
+                self._warmup_connections(),
+                self._warmup_keys(),
+                self._warmup_personas()
+            )
+        except Exception as e:
+            logger.error("启动预热失败: %s", str(e))
+            report.update({"healthy": False, "error": str(e)})
+        else:
+            report.update({
+                "healthy": all(h["ok"] for h in hosts)
+                and all(k["status"] != "invalid" for k in keys)
+                and all(p["ok"] for p in personas),
+                "hosts": hosts,
+                "keys": keys,
+                "personas": personas
+            })
+            logger.info(
+                "启动预热完成：连接 %d/%d，密钥 %d/%d 有效，人格 %d/%d 就绪",
+                sum(h["ok"] for h in hosts), len(hosts),
+                sum(k["status"] == "valid" for k in keys), len(keys),
+                sum(p["ok"] for p in personas), len(personas)
+            )
+        report["finished_at"] = datetime.now().isoformat(timespec="seconds")
+        report["duration_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        self.startup_report = report
+        try:
+            await asyncio.to_thread(self._write_report, "startup.json", report)
+        except Exception as e:
+            logger.error("写入启动报告失败: %s", str(e))
+    
+    async def _warmup_connections(self) -> List[Dict[str, Any]]:
+        """解析各上游域名并建立连接，连接留在共享会话的连接池里供首个请求复用"""
+        targets = [("gitee", self.txt2img_endpoint), ("gitee", self.img2img_endpoint)]
+        if self.use_polish and self.sf_key:
+            targets.append(("siliconflow", self.sf_url))
+        if self.use_shared_pool and self.shared_pool_url:
+            targets.append(("shared_pool", self.shared_pool_url))
+        # 图片CDN的域名只能从生图响应中得知，需要在配置里手动填写
+        targets.extend(("cdn", url) for url in self.warmup_urls)
+        
+        origins: Dict[str, str] = {}
+        for upstream, url in targets:
+            parts = urlsplit(url)
+            if parts.scheme and parts.netloc:
+                origins.setdefault(f"{parts.scheme}://{parts.netloc}", upstream)
+        
+        session = await self._get_http_session()
+        
+        async def connect(origin: str, upstream: str) -> Dict[str, Any]:
+            start = time.perf_counter()
+            entry = {"upstream": upstream, "host": origin}
+            try:
+                # 只需要完成DNS、TCP和TLS握手，任何HTTP状态码都说明连接可用
+                async with session.head(f"{origin}/", allow_redirects=False, timeout=10) as resp:
+                    entry.update({"ok": True, "status": resp.status})
+            except Exception as e:
+                entry.update({"ok": False, "error": str(e) or type(e).__name__})
+            entry["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            return entry
+        
+        return list(await asyncio.gather(*(connect(origin, upstream) for origin, upstream in origins.items())))
+    
+    async def _warmup_keys(self) -> List[Dict[str, Any]]:
+        """用查询模型列表的请求校验每个密钥，不消耗生图额度"""
+        if not self.warmup_validate_keys:
+            return []
+        
+        checks = []
+        if "/images/" in self.txt2img_endpoint:
+            models_url = self.txt2img_endpoint.rsplit("/images/", 1)[0] + "/models"
+            checks.extend(("gitee", key, models_url) for key in self.key_pool.keys)
+        if self.use_polish and self.sf_key:
+            checks.append(("siliconflow", self.sf_key, f"{self.sf_url.rstrip('/')}/models"))
+        
+        session = await self._get_http_session()
+        
+        async def validate(upstream: str, key: str, url: str) -> Dict[str, Any]:
+            entry = {"upstream": upstream, "key": ApiKeyPool.mask(key)}
+            try:
+                async with session.get(url, headers={"Authorization": f"Bearer {key}"}, timeout=10) as resp:
+                    entry["http_status"] = resp.status
+                    if resp.status == 200:
+                        entry["status"] = "valid"
+                    elif resp.status in (401, 403):
+                        entry["status"] = "invalid"
+                        logger.warning("%s 密钥 %s 校验失败（HTTP %s）", upstream, entry["key"], resp.status)
+                        if upstream == "gitee":
+                            self.key_pool.mark_invalid(key)
+                    else:
+                        entry["status"] = "unknown"
+            except Exception as e:
+                entry.update({"status": "unknown", "error": str(e) or type(e).__name__})
+            return entry
+        
+        return list(await asyncio.gather(*(validate(*check) for check in checks)))
+    
+    async def _warmup_personas(self) -> List[Dict[str, Any]]:
+        """加载人格索引，编译润色模板，并按生图尺寸预处理形象图放入缓存"""
+        await asyncio.to_thread(self.persona_store.refresh, True)
+        
+        results = []
+        for entry in list(self.persona_store.personas):
+            item = {"persona_id": entry.get("persona_id"), "ok": True}
+            if self.use_polish and entry.get("polished_prompt"):
+                await self._persona_polish_template(entry)
+            if entry.get("png_path", "").strip():
+                reference = await self._prepare_reference_image(entry)
+                item["reference"] = reference["success"]
+                item["ok"] = reference["success"]
+            results.append(item)
+        return results
     
     async def terminate(self):
         """插件终止时清理资源"""
-        self.processing.clear()
+        if self._warmup_task is not None:
+            self._warmup_task.cancel()
+        if self._housekeeping_task is not None:
+            self._housekeeping_task.cancel()
+        for job in self.background_jobs.values():
+            if job.task is not None and not job.finished:
+                job.task.cancel()
+        self.scheduler.clear()
+        await self._close_http_session()
+        try:
+            await asyncio.to_thread(self.polish_cache.save)
+        except Exception as e:
+            logger.error("保存润色缓存失败: %s", str(e))
+        logger.info("润色缓存统计: %s", self.polish_cache.stats())
+        if self.result_cache_enabled:
+            try:
+                await asyncio.to_thread(self.result_cache.save)
+            except Exception as e:
+                logger.error("保存生图结果缓存失败: %s", str(e))
+            logger.info("生图结果缓存统计: %s", self.result_cache.stats())
+        if self._quota_save_handle is not None:
+            self._quota_save_handle.cancel()
+        await self._save_quota()
+        if self._metrics_flush_handle is not None:
+            self._metrics_flush_handle.cancel()
+        await self._flush_metrics()
+        await self.log_writer.close()
         logger.info("YOIMG插件已停止")
\ No newline at end of file